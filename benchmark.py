@@ -0,0 +1,462 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import argparse, gc, json, multiprocessing, os, platform, random, shutil, subprocess, sys, tempfile, time
+from collections import OrderedDict
+
+import convert
+
+words = (u"lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod "
+         u"tempor incididunt ut labore et dolore magna aliqua filter block element "
+         u"ads tracking privacy subscription").split()
+
+class CorpusGenerator(object):
+  """
+  Writes a synthetic Anwiki content mirror. The translations of a file share
+  the structure of the English one and only differ in their text, as they do
+  in the real mirror. Everything is derived from the seed, so the same options
+  always give the same corpus.
+  """
+  def __init__(self, path, pages=50, locales=len(convert.locales), depth=3,
+               inline_density=0.5, coverage=0.8, seed=1):
+    self.path = path
+    self.pages = pages
+    self.locales = ("en",) + tuple(l for l in convert.locales if l != "en")[:max(locales - 1, 0)]
+    self.depth = depth
+    self.inline_density = inline_density
+    self.coverage = coverage
+    self.seed = seed
+    self.files = 0
+
+  def write(self, path, data):
+    path = os.path.join(self.path, path)
+    convert.ensure_dir(path)
+    with open(path, "wb") as handle:
+      handle.write(data.encode("utf-8") if isinstance(data, unicode) else data)
+    self.files += 1
+
+  def is_translated(self, name, locale):
+    # Decided independently of the file's content, so that it doesn't change
+    # the structure generated for the other locales
+    rng = random.Random("%i:%s:%s" % (self.seed, name, locale))
+    return locale == "en" or rng.random() < self.coverage
+
+  def text(self, rng, locale, count):
+    result = " ".join(rng.choice(words) for i in range(count))
+    untranslated = rng.random() >= self.coverage
+    if locale == "en":
+      return result
+    return u"[untr]" if untranslated else u"%s\u00B7%s" % (locale, result)
+
+  def inline(self, rng, locale):
+    kind = rng.random()
+    extra = rng.choice((u"", u" -- dash", u" \u00AB quoted \u00BB", u" &amp; more",
+                        u"&nbsp;x", u" &mdash; y", u" &euro;5", u" 1 &lt; 2",
+                        u"\n\t  wrapped line", u" {x}"))
+    if rng.random() >= self.inline_density:
+      return self.text(rng, locale, rng.randint(1, 8)) + extra
+    elif kind < 0.2:
+      return u"<strong>%s</strong>" % self.text(rng, locale, rng.randint(1, 3))
+    elif kind < 0.35:
+      return u"<em>%s</em>" % self.text(rng, locale, 2)
+    elif kind < 0.45:
+      return u"<code>%s</code>" % rng.choice((u"a.b()", u"x &lt; y", u"$foo"))
+    elif kind < 0.65:
+      return u'<a href="en/%s">%s</a>' % (rng.choice((u"faq", u"features", u"about")),
+                                          self.text(rng, locale, 2))
+    elif kind < 0.75:
+      return u'<a><attr name="href">%s</attr>%s</a>' % (
+        rng.choice((u"https://example.com/x?a=1&amp;b=2", u"en/faq", u"/de/about")),
+        self.text(rng, locale, 2))
+    elif kind < 0.85:
+      return u"<fix>%s</fix>" % rng.choice((u"Adblock Plus", u"ABP", u"@user"))
+    elif kind < 0.9:
+      return u"<br/>"
+    return u'<img src="en/pic.png" alt="%s">dummy</img>' % self.text(rng, locale, 1)
+
+  def block(self, rng, locale, depth):
+    kind = rng.random()
+    if depth >= self.depth or kind < 0.4:
+      return u"<p>%s</p>" % u"".join(self.inline(rng, locale) for i in range(rng.randint(1, 6)))
+    elif kind < 0.5:
+      return u"<ul>\n%s\n</ul>" % u"\n".join(u"  <li>%s</li>" % self.inline(rng, locale)
+                                             for i in range(rng.randint(1, 4)))
+    elif kind < 0.55:
+      return u"<pre>\tcode\tline  \n  x\t= 1;\t</pre>"
+    elif kind < 0.6:
+      return u"<!-- comment %i -->" % depth
+    elif kind < 0.7:
+      return u'<h2 id="h%i"><attr name="class">big</attr>%s</h2>' % (depth, self.text(rng, locale, 3))
+    elif kind < 0.75:
+      return u'<div class="x"><notoc>%s</notoc></div>' % self.text(rng, locale, 3)
+    elif kind < 0.8:
+      return u"<table><tr><td>%s</td><td><fix>v1.2</fix></td></tr></table>" % self.text(rng, locale, 2)
+    return u"<div>\n%s\n</div>" % u"\n".join(self.block(rng, locale, depth + 1)
+                                             for i in range(rng.randint(1, 3)))
+
+  def page(self, name, locale, extra=u""):
+    rng = random.Random("%i:%s" % (self.seed, name))
+    title = self.text(rng, locale, 3)
+    body = u"\n".join(self.block(rng, locale, 0) for i in range(rng.randint(2, 8)))
+    return (u"<title><anwv>%s</anwv></title><head><anwv><meta name=\"x\" content=\"y\"/>"
+            u"<script src=\"/deregifier.js\"></script></anwv></head>"
+            u"<body><anwv>\n%s%s\n  </anwv></body>" % (title, body, extra))
+
+  def interface(self, name, locale):
+    rng = random.Random("%i:%s" % (self.seed, name))
+    properties = u"".join(
+      u"<property><name><anwv>prop%i</anwv></name><type><anwv>String</anwv></type>"
+      u"<modifier><anwv>%s</anwv></modifier><description><anwv><p>%s</p></anwv></description></property>" %
+      (i, u"readonly" if i % 2 else u"", self.text(rng, locale, 6)) for i in range(rng.randint(1, 5)))
+    methods = u"".join(
+      u"<method><name><anwv>method%i</anwv></name><return_type><anwv>%s</anwv></return_type>"
+      u"<version><anwv>%s</anwv></version><description><anwv>%s <code>method%i</code></anwv></description>"
+      u"<return_description><anwv>%s</anwv></return_description><arguments>%s</arguments></method>" %
+      (i, u"void" if i == 0 else u"Boolean", u"2.1" if i == 1 else u"", self.text(rng, locale, 8), i,
+       self.text(rng, locale, 3), u"".join(
+         u"<argument><name><anwv>arg%i</anwv></name><type><anwv>Integer</anwv></type>"
+         u"<description><anwv>%s</anwv></description></argument>" % (j, self.text(rng, locale, 5))
+         for j in range(i)))
+      for i in range(rng.randint(1, 5)))
+    return (u"<title><anwv>%s</anwv></title><description><anwv><p>%s <a href=\"en/faq\">%s</a></p>"
+            u"</anwv></description><properties>%s</properties><methods>%s</methods>" %
+            (self.text(rng, locale, 2), self.text(rng, locale, 10), self.text(rng, locale, 1),
+             properties, methods))
+
+  def preftable(self, name, locale):
+    rng = random.Random("%i:%s" % (self.seed, name))
+    sections = u"".join(
+      u"<section><id><anwv>section%i</anwv></id><title><anwv>%s</anwv></title><preferences>%s</preferences></section>" %
+      (i, self.text(rng, locale, 2), u"".join(
+        u"<preference><name><anwv>extensions.%s.pref%i</anwv></name><default><anwv>%s</anwv></default>"
+        u"<empty><anwv>%s</anwv></empty><description><anwv>%s</anwv></description></preference>" %
+        (name, j, u"true" if j % 3 else u"", u"true" if j % 3 == 2 else u"false", self.text(rng, locale, 6))
+        for j in range(rng.randint(1, 6))))
+      for i in range(rng.randint(1, 3)))
+    return (u"<title><anwv>%s</anwv></title><description><anwv><p>%s</p></anwv></description>"
+            u"<prefnamecol><anwv>%s</anwv></prefnamecol><defaultcol><anwv>%s</anwv></defaultcol>"
+            u"<descriptioncol><anwv>%s</anwv></descriptioncol><emptydefault><anwv>%s</anwv></emptydefault>"
+            u"<sections>%s</sections>" %
+            (self.text(rng, locale, 2), self.text(rng, locale, 10), self.text(rng, locale, 1),
+             self.text(rng, locale, 1), self.text(rng, locale, 1), self.text(rng, locale, 1), sections))
+
+  def subscriptionlist(self, name, locale):
+    rng = random.Random("%i:%s" % (self.seed, name))
+    return (u"<title><anwv>%s</anwv></title><header><anwv><p>%s</p></anwv></header>"
+            u"<footer><anwv><p>%s <strong>%s</strong></p></anwv></footer><subst>%s</subst>" %
+            (self.text(rng, locale, 2), self.text(rng, locale, 10), self.text(rng, locale, 5),
+             self.text(rng, locale, 1), u"".join(
+               u"<item><name><anwv>%s</anwv></name><text><anwv>%s</anwv></text></item>" %
+               (key, self.text(rng, locale, 2)) for key in (u"type_ads", u"type_other"))))
+
+  def generate(self):
+    others = max(self.pages // 20, 1)
+    for locale in self.locales:
+      if self.is_translated("page!index", locale):
+        self.write("page!%s" % locale, self.page("page!index", locale))
+      for i in range(self.pages):
+        name = "%spage!page%i" % ("sub/" if i % 5 == 4 else "", i)
+        if self.is_translated(name, locale):
+          extra = u'<anwtoc page="en/faq" titletag="h2"></anwtoc>' if i % 7 == 3 else u""
+          self.write("%s/%s" % (locale, name), self.page(name, locale, extra))
+      for generate, kind in ((self.interface, "interface"), (self.preftable, "preftable"),
+                             (self.subscriptionlist, "subscriptionlist")):
+        for i in range(others):
+          name = "%s!%s%i" % (kind, kind, i)
+          if self.is_translated(name, locale):
+            self.write("%s/%s" % (locale, name), generate(name, locale))
+
+      self.write("%s/_include/page!footer" % locale,
+                 u"<title><anwv>Footer</anwv></title><body><anwv><h1>Resources</h1><h1>Community</h1>"
+                 u"<h1>Development</h1><h1>Follow us</h1><a href=\"/about/\">About</a>"
+                 u"<a href=\"https://issues.adblockplus.org/report/13\">Roadmap</a></anwv></body>")
+      self.write("%s/_include/menu!menu" % locale, u"<items>%s</items>" % u"".join(
+        u"<item><mainlink><anwv><title><anwv>%s</anwv></title><url><anwv>%s</anwv></url></anwv></mainlink></item>" %
+        (self.text(random.Random(url), locale, 1), url) for url in (u"en", u"en/faq", u"/search/")))
+
+      # Most locale variants of images are copies of the English one
+      for i in range(others):
+        rng = random.Random("%i:image%i" % (self.seed, i))
+        data = "".join(chr(rng.getrandbits(8)) for j in range(rng.randint(1000, 20000)))
+        if self.is_translated("image!pic%i.png" % i, locale):
+          if locale != "en" and rng.random() < 0.2:
+            data = locale + data
+          self.write("%s/image!pic%i.png" % (locale, i), data)
+
+    for i in range(others):
+      self.write("images/image!logo%i.png" % i, "LOGO%i" % i)
+      self.write("_include/animation!anim_%i.xml" % i,
+                 u"<width><anwv>100</anwv></width><height><anwv>50</anwv></height><data><anwv>"
+                 u"<object src=\"logo%i.png\" x=\"1\"/><text>Hi &amp; bye</text></anwv></data>" % i)
+    return self.files
+
+def generate_corpus(args):
+  if os.path.exists(args.path) and os.listdir(args.path):
+    sys.exit("%s exists and isn't empty" % args.path)
+  generator = CorpusGenerator(args.path, args.pages, args.locales, args.depth,
+                              args.inline_density, args.coverage, args.seed)
+  print "Wrote %i files to %s" % (generator.generate(), args.path)
+
+def find_xml_files(path):
+  result = []
+  for dirpath, dirnames, filenames in os.walk(path):
+    dirnames.sort()
+    for filename in sorted(filenames):
+      if "!" in filename and not filename.startswith("image!"):
+        result.append(os.path.relpath(os.path.join(dirpath, filename), path))
+  return result
+
+def measure_parser(backend, paths, repeat):
+  convert.xml_parser = backend
+  best = None
+  for i in range(repeat):
+    start = time.time()
+    for path in paths:
+      convert.read_xml(path)
+    elapsed = time.time() - start
+    best = elapsed if best is None else min(best, elapsed)
+
+  gc.collect()
+  before = convert.get_rss()
+  documents = [convert.read_xml(path) for path in paths]
+  gc.collect()
+  memory = convert.get_rss() - before
+  del documents
+  return best, memory
+
+def run_isolated(func, *args):
+  # Run every measurement in a fresh process so that memory use of one doesn't
+  # distort the next
+  pool = multiprocessing.Pool(1)
+  try:
+    return pool.apply(func, args)
+  finally:
+    pool.terminate()
+    pool.join()
+
+stages = ("read_xml", "merge_children", "process_body", "xml_to_text", "raw_to_template")
+
+def find_pages(path):
+  return [p for p in find_xml_files(path)
+          if p == "page!en" or (p.startswith("en/") and os.path.basename(p).startswith("page!") and
+                                os.path.basename(p) not in ("page!footer", "page!internet-explorer"))]
+
+def get_page_inputs(path):
+  format = "%s/" + path.split("/", 1)[1] if "/" in path else "page!%s"
+  return [(locale, format % locale) for locale in convert.get_input_locales(format)]
+
+def merge_tree(node):
+  # Only the merge_children() part of process_body()
+  stack = [node]
+  while stack:
+    node = stack.pop()
+    if (node.node.nodeType == convert.Node.ELEMENT_NODE and
+        node.node.tagName not in ("style", "script", "fix", "pre")):
+      convert.merge_children(node)
+      stack.extend(node.children)
+
+def measure_stages(pages, repeat):
+  convert.index_inputs()
+  pages = map(get_page_inputs, pages)
+  best = {}
+  for i in range(repeat):
+    convert.attribute_parser = convert.AttributeParser(convert.tag_whitelist)
+    timings = dict.fromkeys(stages, 0.0)
+    def timed(stage, func, *args):
+      start = time.time()
+      result = func(*args)
+      timings[stage] += time.time() - start
+      return result
+    def read_bodies(inputs, stage=None):
+      read = lambda: [(locale, convert.read_xml(path)) for locale, path in inputs]
+      data = timed(stage, read) if stage else read()
+      return dict((locale, convert.get_element(value.documentElement, "body", "anwv"))
+                  for locale, value in data)
+
+    for inputs in pages:
+      # merge_children() changes the documents, the other stages get fresh ones
+      timed("merge_children", merge_tree, convert.align(read_bodies(inputs, "read_xml")))
+      bodies = read_bodies(inputs)
+      strings = dict((locale, OrderedDict()) for locale in bodies)
+      timed("process_body", convert.process_body, convert.align(bodies), strings)
+      text = timed("xml_to_text", convert.xml_to_text, bodies["en"], strings)
+      timed("raw_to_template", convert.raw_to_template, text)
+
+    for stage, elapsed in timings.iteritems():
+      best[stage] = elapsed if stage not in best else min(best[stage], elapsed)
+  best["pages"] = len(pages)
+  best["files"] = sum(map(len, pages))
+  return best
+
+def measure_convert(root, repeat, jobs):
+  script = os.path.splitext(os.path.abspath(convert.__file__))[0] + ".py"
+  output_dir = os.path.join(root, "web.adblockplus.org")
+  best = None
+  for i in range(repeat):
+    shutil.rmtree(output_dir, ignore_errors=True)
+    start = time.time()
+    process = subprocess.Popen([sys.executable, script, "--force", "--jobs", str(jobs)],
+                               cwd=os.path.join(root, "website-converter"),
+                               stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    stdout, stderr = process.communicate()
+    elapsed = time.time() - start
+    if process.returncode:
+      sys.exit("Conversion failed:\n%s" % stderr)
+    best = elapsed if best is None else min(best, elapsed)
+  return best
+
+def get_revision():
+  try:
+    return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+                                   cwd=os.path.dirname(os.path.abspath(__file__)),
+                                   stderr=subprocess.PIPE).strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+def make_corpus(root, args, pages):
+  generator = CorpusGenerator(os.path.join(root, "www"), pages, args.locales, args.depth,
+                              args.inline_density, args.coverage, args.seed)
+  files = generator.generate()
+  os.mkdir(os.path.join(root, "website-converter"))
+  return files
+
+def benchmark_run(args):
+  results = {
+    "revision": get_revision(),
+    "python": platform.python_version(),
+    "cpus": multiprocessing.cpu_count(),
+    "time": int(time.time()),
+    "repeat": args.repeat,
+    "corpus": {"locales": args.locales, "depth": args.depth, "inline_density": args.inline_density,
+               "coverage": args.coverage, "seed": args.seed, "stage_pages": args.stage_pages,
+               "input_dir": args.input_dir},
+    "convert": []
+  }
+
+  root = tempfile.mkdtemp(prefix="convert-benchmark-")
+  cwd = os.getcwd()
+  try:
+    if args.input_dir:
+      os.chdir(args.input_dir)
+    else:
+      make_corpus(os.path.join(root, "stages"), args, args.stage_pages)
+      os.chdir(os.path.join(root, "stages", "www"))
+    pages = find_pages(".")
+    if not pages:
+      sys.exit("No pages found in %s" % os.getcwd())
+    result = run_isolated(measure_stages, pages, args.repeat)
+    os.chdir(cwd)
+    results["stages"] = result
+
+    print "Stages for %i pages (%i files), best of %i runs" % (result["pages"], result["files"], args.repeat)
+    print "%-16s %10s %12s" % ("stage", "time (s)", "ms/page")
+    for stage in stages:
+      print "%-16s %10.3f %12.2f" % (stage, result[stage], result[stage] * 1000 / result["pages"])
+    print "(process_body includes merge_children)"
+    print
+
+    print "End-to-end conversion with --jobs %i, best of %i runs" % (args.jobs, args.repeat)
+    print "%-10s %10s %10s %10s" % ("pages", "files", "time (s)", "files/s")
+    for size in args.sizes:
+      path = os.path.join(root, "size-%i" % size)
+      files = make_corpus(path, args, size)
+      elapsed = measure_convert(path, args.repeat, args.jobs)
+      shutil.rmtree(path)
+      results["convert"].append({"pages": size, "files": files, "jobs": args.jobs, "time": elapsed})
+      print "%-10i %10i %10.3f %10.1f" % (size, files, elapsed, files / elapsed)
+  finally:
+    os.chdir(cwd)
+    shutil.rmtree(root, ignore_errors=True)
+
+  if args.output:
+    with open(args.output, "wb") as handle:
+      json.dump(results, handle, indent=2, separators=(',', ': '), sort_keys=True)
+    print "Results written to %s" % args.output
+
+def benchmark_compare(args):
+  with open(args.old, "rb") as handle:
+    old = json.load(handle)
+  with open(args.new, "rb") as handle:
+    new = json.load(handle)
+  print "Comparing %s (%s) to %s (%s)" % (args.old, old.get("revision"), args.new, new.get("revision"))
+  if old["corpus"] != new["corpus"]:
+    print "Warning: the results were measured on different corpora"
+
+  print "%-20s %10s %10s %8s" % ("", "old (s)", "new (s)", "change")
+  def compare(name, old_time, new_time):
+    print "%-20s %10.3f %10.3f %+7.1f%%" % (name, old_time, new_time,
+                                            (new_time / old_time - 1) * 100 if old_time else 0)
+  if "stages" in old and "stages" in new and old["stages"]["files"] == new["stages"]["files"]:
+    for stage in stages:
+      compare(stage, old["stages"][stage], new["stages"][stage])
+  old_sizes = dict((entry["pages"], entry) for entry in old["convert"])
+  for entry in new["convert"]:
+    if entry["pages"] in old_sizes:
+      compare("convert %i pages" % entry["pages"], old_sizes[entry["pages"]]["time"], entry["time"])
+
+def benchmark_parser(args):
+  os.chdir(args.input_dir)
+  paths = find_xml_files(".")
+  if not paths:
+    sys.exit("No input files found in %s" % args.input_dir)
+
+  print "Parsing %i files, best of %i runs" % (len(paths), args.repeat)
+  print "%-10s %10s %10s %14s" % ("backend", "time (s)", "files/s", "memory (MB)")
+  for backend in ("minidom", "expat"):
+    elapsed, memory = run_isolated(measure_parser, backend, paths, args.repeat)
+    print "%-10s %10.3f %10.1f %14.1f" % (backend, elapsed, len(paths) / elapsed,
+                                          memory / 1024.0 / 1024.0)
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Benchmarks for convert.py.")
+  subparsers = parser.add_subparsers()
+
+  parser_parser = subparsers.add_parser("parser", help="compare the read_xml parser backends")
+  parser_parser.add_argument("--input-dir", default=convert.input_dir,
+                             help="Anwiki content mirror to parse (default: %(default)s)")
+  parser_parser.add_argument("--repeat", type=int, default=3,
+                             help="number of timed runs per backend (default: %(default)s)")
+  parser_parser.set_defaults(func=benchmark_parser)
+
+  def add_corpus_arguments(subparser):
+    subparser.add_argument("--locales", type=int, default=len(convert.locales),
+                           help="number of locales, including en (default: %(default)s)")
+    subparser.add_argument("--depth", type=int, default=3,
+                           help="maximal nesting depth of block elements (default: %(default)s)")
+    subparser.add_argument("--inline-density", type=float, default=0.5,
+                           help="share of inline markup among the text runs, 0 to 1 (default: %(default)s)")
+    subparser.add_argument("--coverage", type=float, default=0.8,
+                           help="share of files and strings which are translated, 0 to 1 (default: %(default)s)")
+    subparser.add_argument("--seed", type=int, default=1,
+                           help="random seed, the same options give the same corpus (default: %(default)s)")
+
+  generate_parser = subparsers.add_parser("generate", help="write a synthetic Anwiki content mirror")
+  generate_parser.add_argument("path", help="directory to write the content mirror to")
+  generate_parser.add_argument("--pages", type=int, default=50,
+                               help="number of pages (default: %(default)s)")
+  add_corpus_arguments(generate_parser)
+  generate_parser.set_defaults(func=generate_corpus)
+
+  run_parser = subparsers.add_parser("run", help="time the conversion stages and end-to-end runs on synthetic corpora")
+  run_parser.add_argument("--sizes", type=lambda s: map(int, s.split(",")), default=[10, 50, 200],
+                          help="comma separated corpus sizes in pages for the end-to-end runs (default: 10,50,200)")
+  run_parser.add_argument("--stage-pages", type=int, default=50,
+                          help="corpus size in pages for timing the stages (default: %(default)s)")
+  run_parser.add_argument("--input-dir",
+                          help="time the stages on this content mirror instead of a synthetic one")
+  run_parser.add_argument("--repeat", type=int, default=3,
+                          help="number of timed runs (default: %(default)s)")
+  run_parser.add_argument("-j", "--jobs", type=int, default=1,
+                          help="jobs for the end-to-end runs (default: %(default)s)")
+  run_parser.add_argument("-o", "--output",
+                          help="write the results as JSON to this file")
+  add_corpus_arguments(run_parser)
+  run_parser.set_defaults(func=benchmark_run)
+
+  compare_parser = subparsers.add_parser("compare", help="compare the results of two benchmark runs")
+  compare_parser.add_argument("old", help="JSON results of the baseline run")
+  compare_parser.add_argument("new", help="JSON results to compare to the baseline")
+  compare_parser.set_defaults(func=benchmark_compare)
+
+  args = parser.parse_args()
+  args.func(args)
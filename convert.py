@@ -1,17 +1,81 @@
 #!/usr/bin/env python
 # coding: utf-8
 
-import HTMLParser, codecs, errno, itertools, json, os, re, sys
-from collections import OrderedDict
+import HTMLParser, StringIO, argparse, cStringIO, cProfile, errno, fnmatch, functools, gc, hashlib, itertools, json, multiprocessing, multiprocessing.pool, os, re, resource, shutil, sys, tarfile, tempfile, threading, time, traceback, zipfile
+from collections import OrderedDict, defaultdict, deque
 from xml.dom import minidom, Node
+from xml.parsers import expat
+
+try:
+  from os import scandir
+except ImportError:
+  try:
+    # Not part of Python 2, but available as a separate module
+    from scandir import scandir
+  except ImportError:
+    scandir = None
+
+try:
+  # Python 3.4+ or a Python 2 patched with pytracemalloc, tracing is enabled
+  # with PYTHONTRACEMALLOC=1
+  import tracemalloc
+except ImportError:
+  tracemalloc = None
+
+try:
+  from os import sendfile
+except ImportError:
+  # Python 2 doesn't wrap sendfile(), call the libc function directly. Linux
+  # allows regular files as the target, other systems only sockets.
+  sendfile = None
+  if sys.platform.startswith("linux"):
+    try:
+      import ctypes
+      # The interpreter is linked against libc already, no need to look it up
+      libc_sendfile = ctypes.CDLL(None, use_errno=True).sendfile64
+      libc_sendfile.argtypes = (ctypes.c_int, ctypes.c_int, ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t)
+      libc_sendfile.restype = ctypes.c_ssize_t
+
+      def sendfile(out_fd, in_fd, offset, count):
+        offset = ctypes.c_int64(offset)
+        result = libc_sendfile(out_fd, in_fd, ctypes.byref(offset), count)
+        if result < 0:
+          code = ctypes.get_errno()
+          raise OSError(code, os.strerror(code))
+        return result
+    except (ImportError, OSError, AttributeError):
+      pass
 
 h = HTMLParser.HTMLParser()
 
 output_dir = "../web.adblockplus.org"
 input_dir = "../www"
+manifest_file = os.path.join(output_dir, ".convert-manifest.json")
+changes_file = os.path.join(output_dir, ".convert-changes.json")
+journal_file = os.path.join(output_dir, ".convert-journal")
+dependency_file = os.path.join(output_dir, ".convert-dependencies.json")
 locales = ("ar", "bg", "de", "en", "es", "fr", "he", "hu", "ko", "lt", "nl",
            "pt_BR", "ru", "sk", "zh_CN", "zh_TW")
+# Locales whose outputs are written, None for all. The others are still read,
+# templates depend on the strings of all locales.
+selected_locales = None
 entities = {"euro": 8364, "mdash": 8212, "nbsp": 0xA0, "copy": 169}
+xml_parser = "expat"
+# How images get into the output directory: "copy", "hardlink" or "reflink"
+image_copy = "copy"
+copy_threads = 4
+# Number of files whose inputs serial runs load ahead on background threads,
+# while the current file is converted
+read_ahead = 8
+read_threads = 4
+# Leave out locale variants of images which are identical to the English one,
+# the CMS falls back to the default locale for those
+dedup_images = False
+# ioctl from linux/fs.h cloning a file on copy-on-write file systems
+FICLONE = 0x40049409
+# Locale file for the strings which share_strings() finds on several pages
+shared_localefile = "shared-strings"
+shared_strings = False
 
 license_header = """{#
  # This file is part of the Adblock Plus website,
@@ -30,25 +94,167 @@ license_header = """{#
  # along with Adblock Plus.  If not, see <http://www.gnu.org/licenses/>.
  #}"""
 
-string_regexp = (
-  r"{{\s*"
-  r"([\w\-]+)" # String ID
-  r"(?:\[(.*?)\])?" # Optional comment
-  r"\s+"
-  r"((?:(?!{{).|" # Translatable text
-    r"{{(?:(?!}}).)*}}" # Nested translation
-  r")*?)"
-  r"}}"
-)
+# Translatable strings look like {{id[comment] text}}, the text can contain
+# nested {{...}} strings, comments are optional.
+string_id_chars = frozenset("abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789_-")
+string_space_chars = frozenset(" \t\n\r\f\v")
+
+def find_string_end(text, pos):
+  """Returns the position of the "}}" ending string text at pos, or -1"""
+  while True:
+    end = text.find("}}", pos)
+    if end < 0:
+      return -1
+    nested = text.find("{{", pos, end)
+    if nested < 0:
+      return end
+    pos = text.find("}}", nested + 2)
+    if pos < 0:
+      return -1
+    pos += 2
+
+def match_string_text(text, pos):
+  # At least one whitespace character separates the id from the text
+  length = len(text)
+  if pos >= length or text[pos] not in string_space_chars:
+    return None
+  while pos < length and text[pos] in string_space_chars:
+    pos += 1
+  end = find_string_end(text, pos)
+  return (pos, end) if end >= 0 else None
+
+def match_string(text, start):
+  length = len(text)
+  pos = start + 2
+  while pos < length and text[pos] in string_space_chars:
+    pos += 1
+  id_start = pos
+  while pos < length and text[pos] in string_id_chars:
+    pos += 1
+  if pos == id_start:
+    return None
+  id = text[id_start:pos]
+
+  if text.startswith("[", pos):
+    # The comment ends at the first "]" which lets the rest match
+    comment_start = pos + 1
+    pos = text.find("]", comment_start)
+    while pos >= 0:
+      match = match_string_text(text, pos + 1)
+      if match:
+        return start, match[1] + 2, id, text[comment_start:pos], text[match[0]:match[1]]
+      pos = text.find("]", pos + 1)
+    return None
+
+  match = match_string_text(text, pos)
+  if match:
+    return start, match[1] + 2, id, None, text[match[0]:match[1]]
+  return None
+
+def find_strings(text):
+  """
+  Returns (start, end, id, comment, text) for each translatable string in text,
+  scanning it once.
+  """
+  result = []
+  pos = text.find("{{")
+  while pos >= 0:
+    match = match_string(text, pos)
+    if match:
+      result.append(match)
+      pos = text.find("{{", match[1])
+    else:
+      pos = text.find("{{", pos + 1)
+  return result
+
+def replace_strings(text, replace):
+  """Calls replace(id, text) for each translatable string, returns the new text"""
+  result = []
+  pos = 0
+  for start, end, id, comment, message in find_strings(text):
+    result.append(text[pos:start])
+    result.append(replace(id, message))
+    pos = end
+  if not result:
+    return text
+  result.append(text[pos:])
+  return "".join(result)
 
 class AttributeParser(HTMLParser.HTMLParser):
   _string = None
   _attrs = None
 
-  def __init__(self, whitelist):
+  # Strings rarely use more than text, whitelisted tags with quoted attributes
+  # and entities. These are tokenized directly, anything else (including tags
+  # which aren't whitelisted) goes through HTMLParser.
+  _markup_pattern = r"""
+    <([a-z]+)((?:\s+[a-zA-Z_:][-.:a-zA-Z0-9_]*(?:\s*=\s*(?:"[^"]*"|'[^']*'))?)*)\s*>|
+    </([a-zA-Z][-.a-zA-Z0-9:_]*)>|
+    &(\#(?:[0-9]+|[xX][0-9a-fA-F]+)|[a-zA-Z][-.a-zA-Z0-9]*);
+  """
+  _markup_regexp = re.compile(_markup_pattern, re.X)
+  _simple_regexp = re.compile(r"""(?:
+    [^<&]|&(?=[^a-zA-Z\#])|<(?=[^a-zA-Z/!?])|
+  """ + _markup_pattern + r""")*\Z""", re.X)
+  _attr_regexp = re.compile(r"""\s+([^\s=]+)(?:\s*=\s*("[^"]*"|'[^']*'))?""")
+
+  def __init__(self, whitelist, cache_size=10000):
     self._whitelist = whitelist
+    self._cache = OrderedDict()
+    self._cache_size = cache_size
+    self.stats = {"hits": 0, "misses": 0, "fallbacks": 0}
 
   def parse(self, text, pagename):
+    # Texts repeat a lot across locales and pages, keep the most recently used
+    # results. Callers mustn't modify the attributes returned.
+    if text in self._cache:
+      self.stats["hits"] += 1
+      result = self._cache.pop(text)
+    else:
+      self.stats["misses"] += 1
+      result = self._tokenize(text)
+      if result is None:
+        self.stats["fallbacks"] += 1
+        result = self._parse(text, pagename)
+      if len(self._cache) >= self._cache_size:
+        self._cache.popitem(last=False)
+    self._cache[text] = result
+    return result
+
+  def _tokenize(self, text):
+    if "<" not in text and "&" not in text:
+      return text, {}
+    if not self._simple_regexp.match(text):
+      return None
+
+    attrs = {}
+    def replace_markup(match):
+      tag, tag_attrs, endtag, ref = match.groups()
+      if tag is not None:
+        if tag not in self._whitelist:
+          raise KeyError(tag)
+        values = []
+        for name, value in self._attr_regexp.findall(tag_attrs):
+          if not value:
+            value = None
+          elif value[1:-1]:
+            value = self.unescape(value[1:-1])
+          else:
+            value = ""
+          values.append((name.lower(), value))
+        attrs.setdefault(tag, []).append(values)
+        return "<%s>" % tag
+      elif endtag is not None:
+        return "</%s>" % endtag.lower()
+      else:
+        return self.unescape("&%s;" % ref)
+
+    try:
+      return self._markup_regexp.sub(replace_markup, text), attrs
+    except KeyError:
+      return None
+
+  def _parse(self, text, pagename):
     self.reset()
     self._string = []
     self._attrs = {}
@@ -85,6 +291,300 @@ class AttributeParser(HTMLParser.HTMLParser):
 tag_whitelist = {"a", "strong", "em", "code"}
 attribute_parser = AttributeParser(tag_whitelist)
 
+# Locale files written by more than one handler, e.g. interface.json. These are
+# collected here and saved once at the end so that parallel workers don't race.
+shared_locales = {}
+
+# Output files written while converting the current file
+written_files = []
+
+# Content of the current file's inputs loaded by the read-ahead, by path
+prefetched = {}
+
+# What outputs depend on besides the inputs they are converted from, e.g. pages
+# with a table of contents on the page it lists. Maps output paths to sets of
+# input paths and paths relative to the output directory.
+dependencies = {}
+
+# The dependencies of every output in the output directory, by relative path,
+# including the inputs. Kept in dependency_file between runs.
+dependency_graph = {}
+
+# Outputs touched during this run, mapped to the hashes of their previous and
+# their current content. None stands for a file which doesn't exist, an empty
+# string for previous content which wasn't hashed since its size differed.
+output_changes = {}
+
+# Bytes of image data copied and bytes skipped because the target was current,
+# number and size of the locale variants dropped by dedup_images
+copy_stats = {"copied": 0, "skipped": 0, "duplicates": 0, "saved": 0}
+
+# Mode for new files, temporary files are created with restricted permissions
+umask = os.umask(0)
+os.umask(umask)
+
+# Index of the input tree built by index_inputs(): the entries of every
+# directory in listing order, all files, and the locales that have each page
+# (keyed by format strings like "%s/foo/page!bar").
+input_dirs = None
+input_files = None
+input_locales = None
+
+# Collect the files that fail to convert and carry on with the others
+keep_going = False
+
+# Tracer collecting the timings of every converted file, None unless --timings
+# or --trace were given
+tracer = None
+
+# Inputs matching any of these patterns are converted under cProfile, with the
+# statistics written to profile_dir
+profile_patterns = []
+profile_dir = "profiles"
+
+# Release the documents of every file as soon as its outputs are written and
+# record the memory use per file type. memory_budget is in bytes, exceeding it
+# causes a warning, and parallel runs restart their workers.
+bounded_memory = False
+memory_budget = None
+memory_usage = {}
+budget_exceeded = 0
+
+def get_cpu_time():
+  usage = resource.getrusage(resource.RUSAGE_SELF)
+  return usage.ru_utime + usage.ru_stime
+
+class Tracer(object):
+  """
+  Records wall and CPU time spent in the stages of each converted file, along
+  with counters like the number of nodes visited. Stages are nested in the
+  file, time not spent in any of them counts as "other".
+  """
+  def __init__(self):
+    self.files = []
+    self.current = None
+
+  def start_file(self, path):
+    self.current = {"path": path, "type": os.path.basename(path).split("!")[0],
+                    "pid": os.getpid(), "start": time.time(), "cpu": get_cpu_time(),
+                    "stages": [], "counters": {}}
+
+  def end_file(self):
+    current = self.current
+    current["wall"] = time.time() - current["start"]
+    current["cpu"] = get_cpu_time() - current["cpu"]
+    self.files.append(current)
+    self.current = None
+
+  def span(self, name, func, *args, **kwargs):
+    if self.current is None:
+      return func(*args, **kwargs)
+    start = time.time()
+    cpu = get_cpu_time()
+    try:
+      return func(*args, **kwargs)
+    finally:
+      if self.current is not None:
+        self.current["stages"].append((name, start, time.time() - start, get_cpu_time() - cpu))
+
+  def count(self, name, value):
+    if self.current is not None:
+      self.current["counters"][name] = self.current["counters"].get(name, 0) + value
+
+  def print_summary(self, slowest=10):
+    stages = OrderedDict()
+    counters = {}
+    types = {}
+    for record in self.files:
+      other = [record["wall"], record["cpu"]]
+      for name, start, wall, cpu in record["stages"]:
+        totals = stages.setdefault(name, [0, 0.0, 0.0])
+        totals[0] += 1
+        totals[1] += wall
+        totals[2] += cpu
+        other[0] -= wall
+        other[1] -= cpu
+      totals = stages.setdefault("other", [0, 0.0, 0.0])
+      totals[0] += 1
+      totals[1] += other[0]
+      totals[2] += other[1]
+      totals = types.setdefault(record["type"], [0, 0.0, 0.0])
+      totals[0] += 1
+      totals[1] += record["wall"]
+      totals[2] += record["cpu"]
+      for name, value in record["counters"].iteritems():
+        counters[name] = counters.get(name, 0) + value
+
+    total = sum(record["wall"] for record in self.files) or 1
+    print "%-20s %8s %10s %10s %7s" % ("stage", "calls", "wall (s)", "cpu (s)", "share")
+    stages["other"] = stages.pop("other")
+    for name, (calls, wall, cpu) in stages.iteritems():
+      print "%-20s %8i %10.3f %10.3f %6.1f%%" % (name, calls, wall, cpu, 100 * wall / total)
+    print
+    print "%-20s %8s %10s %10s" % ("file type", "files", "wall (s)", "cpu (s)")
+    for name, (calls, wall, cpu) in sorted(types.iteritems()):
+      print "%-20s %8i %10.3f %10.3f" % (name, calls, wall, cpu)
+    print
+    print "Counters: " + ", ".join("%s %i" % item for item in sorted(counters.iteritems()))
+    print "Slowest files:"
+    for record in sorted(self.files, key=lambda record: -record["wall"])[:slowest]:
+      print "  %8.3fs %s" % (record["wall"], record["path"])
+
+  def save_chrome_trace(self, path):
+    """Writes the timings in the Trace Event Format, for chrome://tracing or
+    https://ui.perfetto.dev/"""
+    epoch = min(record["start"] for record in self.files) if self.files else 0
+    events = []
+    for record in self.files:
+      args = dict(record["counters"], cpu=round(record["cpu"], 6))
+      events.append({"name": record["path"], "cat": record["type"], "ph": "X",
+                     "ts": int((record["start"] - epoch) * 1e6), "dur": int(record["wall"] * 1e6),
+                     "pid": record["pid"], "tid": record["pid"], "args": args})
+      for name, start, wall, cpu in record["stages"]:
+        events.append({"name": name, "cat": "stage", "ph": "X",
+                       "ts": int((start - epoch) * 1e6), "dur": int(wall * 1e6),
+                       "pid": record["pid"], "tid": record["pid"], "args": {"cpu": round(cpu, 6)}})
+    with open(path, "wb") as handle:
+      json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, handle)
+
+def traced(name):
+  """Decorator recording calls of the function as a stage of the current file"""
+  def decorator(func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+      if tracer is None:
+        return func(*args, **kwargs)
+      return tracer.span(name, func, *args, **kwargs)
+    return wrapper
+  return decorator
+
+def trace_count(name, value):
+  if tracer is not None:
+    tracer.count(name, value)
+
+def get_rss():
+  """Returns the current resident set size in bytes"""
+  try:
+    with open("/proc/self/statm", "rb") as handle:
+      return int(handle.read().split()[1]) * resource.getpagesize()
+  except IOError:
+    # Only the peak is available here
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def record_memory(path):
+  usage = memory_usage.setdefault(os.path.basename(path).split("!")[0], {
+    "files": 0, "rss": 0, "traced": 0, "allocators": []
+  })
+  usage["files"] += 1
+  usage["rss"] = max(usage["rss"], get_rss())
+  if tracemalloc is not None and tracemalloc.is_tracing():
+    traced = tracemalloc.get_traced_memory()[0]
+    if traced > usage["traced"]:
+      # Only the largest file of each type is worth a snapshot
+      statistics = tracemalloc.take_snapshot().statistics("lineno")
+      usage["traced"] = traced
+      usage["allocators"] = [(str(stat.traceback), stat.size, stat.count) for stat in statistics[:5]]
+
+def merge_memory_usage(usage):
+  for kind, value in usage.iteritems():
+    if kind not in memory_usage:
+      memory_usage[kind] = value
+      continue
+    merged = memory_usage[kind]
+    merged["files"] += value["files"]
+    merged["rss"] = max(merged["rss"], value["rss"])
+    if value["traced"] > merged["traced"]:
+      merged["traced"] = value["traced"]
+      merged["allocators"] = value["allocators"]
+
+def release_documents(path, documents):
+  """Breaks up the reference cycles of a file's documents once its outputs are
+  written, their memory is freed right away then rather than whenever the
+  garbage collector gets to them."""
+  if not bounded_memory:
+    return
+  record_memory(path)
+  for document in documents:
+    document.unlink()
+
+def check_memory_budget(path):
+  global budget_exceeded
+  if get_rss() <= memory_budget:
+    return
+  gc.collect()
+  rss = get_rss()
+  if rss > memory_budget:
+    budget_exceeded += 1
+    print >>sys.stderr, "Warning: %.1f MB in use after converting %s, the memory budget is %.1f MB" % (
+      rss / 1024.0 / 1024.0, path, memory_budget / 1024.0 / 1024.0)
+
+def print_memory_report():
+  megabytes = lambda size: size / 1024.0 / 1024.0
+  print "%-20s %8s %12s %12s" % ("file type", "files", "RSS (MB)", "traced (MB)")
+  for kind, usage in sorted(memory_usage.iteritems()):
+    print "%-20s %8i %12.1f %12.1f" % (kind, usage["files"], megabytes(usage["rss"]),
+                                       megabytes(usage["traced"]))
+    for location, size, count in usage["allocators"]:
+      print "    %10.1f KB %8i blocks  %s" % (size / 1024.0, count, location)
+  peak = "Peak RSS: %.1f MB" % megabytes(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024)
+  workers = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024
+  if workers:
+    peak += ", largest worker %.1f MB" % megabytes(workers)
+  print peak
+  if tracemalloc is not None and not tracemalloc.is_tracing():
+    print "Run with PYTHONTRACEMALLOC=1 to see the top allocators"
+
+def list_dir(path):
+  if scandir:
+    for entry in scandir(path):
+      yield entry.name, entry.is_dir()
+  else:
+    for name in os.listdir(path):
+      yield name, os.path.isdir(os.path.join(path, name))
+
+def index_inputs():
+  """Walks the input directory once, input_exists() and get_input_locales()
+  then won't need to touch the file system."""
+  global input_dirs, input_files, input_locales
+  input_dirs = {}
+  input_files = set()
+  input_locales = {}
+  stack = [""]
+  while stack:
+    path = stack.pop()
+    entries = input_dirs[path] = []
+    for name, is_dir in list_dir(path or "."):
+      if not path and name.startswith("."):
+        continue
+      entries.append((name, is_dir))
+      if is_dir:
+        stack.append(os.path.join(path, name))
+      else:
+        input_files.add(os.path.join(path, name))
+
+  for path in input_files:
+    if "/" in path:
+      locale, format = path.split("/", 1)[0], "%s/" + path.split("/", 1)[1]
+    elif path.startswith("page!"):
+      locale, format = path[len("page!"):], "page!%s"
+    else:
+      continue
+    if locale in locales:
+      input_locales.setdefault(format, []).append(locale)
+  for value in input_locales.itervalues():
+    value.sort(key=locales.index)
+
+def input_exists(path):
+  if input_files is None:
+    return os.path.exists(path)
+  return path in input_files
+
+def get_input_locales(format):
+  """Returns the locales for which format % locale is an input file"""
+  if input_locales is None:
+    return [locale for locale in locales if os.path.exists(format % locale)]
+  return input_locales.get(format, [])
+
 def ensure_dir(path):
   try:
     os.makedirs(os.path.dirname(path))
@@ -92,9 +592,294 @@ def ensure_dir(path):
     if e.errno != errno.EEXIST:
       raise
 
+class LightNode(object):
+  """
+  Base class for the nodes built by parse_light(). These implement the subset
+  of the xml.dom.minidom interface used here, but with a fraction of the
+  memory and construction time.
+  """
+  __slots__ = ("parentNode",)
+  attributes = None
+  childNodes = ()
+
+  def __init__(self):
+    self.parentNode = None
+
+  @property
+  def ownerDocument(self):
+    return light_document
+
+  def toxml(self):
+    result = []
+    self.writexml(result.append)
+    return "".join(result)
+
+class LightText(LightNode):
+  __slots__ = ("data",)
+  nodeType = Node.TEXT_NODE
+
+  def __init__(self, data):
+    LightNode.__init__(self)
+    self.data = data
+
+  @property
+  def nodeValue(self):
+    return self.data
+
+  @nodeValue.setter
+  def nodeValue(self, value):
+    self.data = value
+
+  def cloneNode(self, deep):
+    return self.__class__(self.data)
+
+  def writexml(self, write):
+    write(escape_xml(self.data))
+
+class LightCDATASection(LightText):
+  __slots__ = ()
+  nodeType = Node.CDATA_SECTION_NODE
+
+  def writexml(self, write):
+    write("<![CDATA[%s]]>" % self.data)
+
+class LightComment(LightText):
+  __slots__ = ()
+  nodeType = Node.COMMENT_NODE
+
+  def writexml(self, write):
+    write("<!--%s-->" % self.data)
+
+class LightProcessingInstruction(LightText):
+  __slots__ = ("target",)
+  nodeType = Node.PROCESSING_INSTRUCTION_NODE
+
+  def __init__(self, target, data):
+    LightText.__init__(self, data)
+    self.target = target
+
+  def cloneNode(self, deep):
+    return LightProcessingInstruction(self.target, self.data)
+
+  def writexml(self, write):
+    write("<?%s %s?>" % (self.target, self.data))
+
+class LightParent(LightNode):
+  __slots__ = ("childNodes",)
+
+  def __init__(self):
+    LightNode.__init__(self)
+    self.childNodes = []
+
+  def appendChild(self, node):
+    node.parentNode = self
+    self.childNodes.append(node)
+    return node
+
+  def removeChild(self, node):
+    self.childNodes.remove(node)
+    node.parentNode = None
+    return node
+
+  def replaceChild(self, new, old):
+    self.childNodes[self.childNodes.index(old)] = new
+    new.parentNode = self
+    old.parentNode = None
+    return old
+
+  def getElementsByTagName(self, name):
+    result = []
+    stack = [iter(self.childNodes)]
+    while stack:
+      for node in stack[-1]:
+        if node.nodeType == Node.ELEMENT_NODE:
+          if node.tagName == name:
+            result.append(node)
+          stack.append(iter(node.childNodes))
+          break
+      else:
+        stack.pop()
+    return result
+
+  def createTextNode(self, data):
+    return LightText(data)
+
+  def unlink(self):
+    # Like minidom's unlink(), breaks the parent references of the subtree
+    stack = [self]
+    while stack:
+      node = stack.pop()
+      for child in node.childNodes:
+        child.parentNode = None
+        if child.childNodes:
+          stack.append(child)
+      node.childNodes = []
+
+class LightElement(LightParent):
+  __slots__ = ("tagName", "_attrs")
+  nodeType = Node.ELEMENT_NODE
+
+  def __init__(self, tagName, attrs=None):
+    LightParent.__init__(self)
+    self.tagName = tagName
+    self._attrs = attrs or None
+
+  @property
+  def nodeName(self):
+    return self.tagName
+
+  @property
+  def nodeValue(self):
+    return None
+
+  @nodeValue.setter
+  def nodeValue(self, value):
+    # Setting the value of an element has no effect, as in minidom
+    pass
+
+  def getAttribute(self, name):
+    return self._attrs.get(name, "") if self._attrs else ""
+
+  def hasAttribute(self, name):
+    return bool(self._attrs) and name in self._attrs
+
+  def setAttribute(self, name, value):
+    if self._attrs is None:
+      self._attrs = {}
+    self._attrs[name] = value
+
+  def cloneNode(self, deep):
+    clone = LightElement(self.tagName, dict(self._attrs) if self._attrs else None)
+    if deep:
+      for child in self.childNodes:
+        clone.appendChild(child.cloneNode(True))
+    return clone
+
+  def writexml(self, write):
+    write("<" + self.tagName)
+    if self._attrs:
+      for name in sorted(self._attrs):
+        write(' %s="%s"' % (name, escape_xml(self._attrs[name])))
+    if self.childNodes:
+      write(">")
+      for child in self.childNodes:
+        child.writexml(write)
+      write("</%s>" % self.tagName)
+    else:
+      write("/>")
+
+class LightDocument(LightParent):
+  __slots__ = ()
+  nodeType = Node.DOCUMENT_NODE
+
+  @property
+  def documentElement(self):
+    for node in self.childNodes:
+      if node.nodeType == Node.ELEMENT_NODE:
+        return node
+    return None
+
+  @property
+  def ownerDocument(self):
+    return None
+
+# Nodes aren't tied to a document, this one is used to create new text nodes.
+light_document = LightDocument()
+
+def escape_xml(text):
+  return text.replace("&", "&amp;").replace("<", "&lt;").replace("\"", "&quot;").replace(">", "&gt;")
+
+def parse_light(xml):
+  document = LightDocument()
+  stack = [document]
+  cdata = [False]
+
+  def start_element(name, attrs):
+    stack.append(stack[-1].appendChild(LightElement(name, attrs)))
+
+  def end_element(name):
+    stack.pop()
+
+  def character_data(data):
+    children = stack[-1].childNodes
+    if cdata[0]:
+      if cdata[0] is True:
+        cdata[0] = stack[-1].appendChild(LightCDATASection(data))
+      else:
+        cdata[0].data += data
+    elif children and children[-1].nodeType == Node.TEXT_NODE:
+      children[-1].data += data
+    else:
+      stack[-1].appendChild(LightText(data))
+
+  def start_cdata():
+    cdata[0] = True
+
+  def end_cdata():
+    # Like minidom, don't create empty CDATA sections
+    cdata[0] = False
+
+  def comment(data):
+    stack[-1].appendChild(LightComment(data))
+
+  def processing_instruction(target, data):
+    stack[-1].appendChild(LightProcessingInstruction(target, data))
+
+  parser = expat.ParserCreate()
+  parser.buffer_text = True
+  parser.StartElementHandler = start_element
+  parser.EndElementHandler = end_element
+  parser.CharacterDataHandler = character_data
+  parser.StartCdataSectionHandler = start_cdata
+  parser.EndCdataSectionHandler = end_cdata
+  parser.CommentHandler = comment
+  parser.ProcessingInstructionHandler = processing_instruction
+  parser.Parse(xml, True)
+  return document
+
+# Stray ampersands and links to English pages, fixed up everywhere
+fix_pattern = re.compile(r'(?<!&)&(?!#?\w+;|&)| (?P<src>src)="en/| href="en(?P<href>/en"|/|")')
+fix_xml_regexp = re.compile(r"(?P<section><!--.*?-->|<!\[CDATA\[.*?\]\]>)|&(?P<entity>\w+);|" +
+                            fix_pattern.pattern, re.S)
+
+def fix_xml(xml):
+  """
+  Escapes stray ampersands, replaces the entities defined in the entities
+  table by character references and fixes up links to English pages, all in
+  a single pass. Like with minidom, entities in comments and CDATA sections
+  are left alone, the rest applies there as well.
+  """
+  def fix(match):
+    groups = match.groupdict()
+    if groups.get("section"):
+      return fix_pattern.sub(fix, groups["section"])
+    elif groups.get("entity"):
+      entity = groups["entity"]
+      return "&#%d;" % entities[entity] if entity in entities else match.group(0)
+    elif groups["src"]:
+      return ' src="'
+    elif groups["href"] == "/":
+      return ' href="'
+    elif groups["href"]:
+      # ' href="en/en"' becomes ' href="en"' and then ' href="index"'
+      return ' href="index"'
+    else:
+      return "&amp;"
+
+  return fix_xml_regexp.sub(fix, xml)
+
+def read_input(path):
+  data = prefetched.pop(path, None)
+  if data is None:
+    with open(path, "rb") as handle:
+      data = handle.read()
+  return data
+
+@traced("read_xml")
 def read_xml(path):
-  with open(path, "rb") as handle:
-    xml = handle.read()
+  xml = read_input(path)
+
+  if xml_parser == "minidom":
     xml = re.sub(r"(?<!&)&(?!#?\w+;|&)", "&amp;", xml)
     xml = xml.replace(' href="en/', ' href="')
     xml = xml.replace(' href="en"', ' href="index"')
@@ -103,23 +888,410 @@ def read_xml(path):
       "".join(["<!ENTITY %s \"&#%d;\">" % (k, v) for k,v in entities.iteritems()]),
       xml
     ))
+  return parse_light("<root>%s</root>" % fix_xml(xml))
 
-def save_locale(path, data):
+def create_temp_file(path):
+  # Write to a temporary file and rename it, readers of the output directory
+  # never get to see a partially written file then.
   ensure_dir(path)
-  with codecs.open(path, "wb", encoding="utf-8") as handle:
-    json.dump(data, handle, ensure_ascii=False, indent=2, separators=(',', ': '))
+  fd, temp_path = tempfile.mkstemp(prefix="." + os.path.basename(path) + ".",
+                                   dir=os.path.dirname(path))
+  return os.fdopen(fd, "wb"), temp_path
+
+def commit_temp_file(temp_path, path, mode=None):
+  os.chmod(temp_path, 0666 & ~umask if mode is None else mode)
+  os.rename(temp_path, path)
+
+def write_file(path, data, mode=None):
+  handle, temp_path = create_temp_file(path)
+  try:
+    with handle:
+      handle.write(data)
+    commit_temp_file(temp_path, path, mode)
+  except:
+    remove_file(temp_path)
+    raise
+
+def copy_data(source, target, size):
+  # Let the kernel move the data where possible instead of reading it into
+  # memory, the plain copy is the fallback for anything it refuses.
+  if image_copy == "reflink":
+    try:
+      import fcntl
+      fcntl.ioctl(target.fileno(), FICLONE, source.fileno())
+      return
+    except (ImportError, IOError):
+      pass
+  if sendfile is not None:
+    offset = 0
+    try:
+      while offset < size:
+        sent = sendfile(target.fileno(), source.fileno(), offset, size - offset)
+        if not sent:
+          break
+        offset += sent
+      return
+    except OSError, e:
+      if e.errno not in (errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP) or offset:
+        raise
+  shutil.copyfileobj(source, target, 1024 * 1024)
+
+def record_copy(target, old, new, copied, skipped):
+  if old != new:
+    record_change(target, old, new)
+  copy_stats["copied"] += copied
+  copy_stats["skipped"] += skipped
+
+def record_dependency(output, dependency):
+  dependencies.setdefault(output, set()).add(dependency)
+
+def record_change(path, old, new):
+  if path in output_changes:
+    output_changes[path][1] = new
+  else:
+    output_changes[path] = [old, new]
+
+def copy_prefix(source, target, size):
+  source.seek(0)
+  while size > 0:
+    block = source.read(min(size, 1024 * 1024))
+    if not block:
+      break
+    target.write(block)
+    size -= len(block)
+
+class DirectorySink(object):
+  """
+  Writes the outputs into the output directory. Files which already have the
+  right content are left alone, so that unchanged files keep their
+  modification time, and later runs only convert what changed.
+  """
+  incremental = True
+
+  def copy(self, source, target):
+    stat = os.stat(source)
+    try:
+      target_stat = os.stat(target)
+    except OSError, e:
+      if e.errno != errno.ENOENT:
+        raise
+      old, linked = None, False
+    else:
+      # A hardlink left by an earlier run is replaced by a copy, unless that is
+      # what was asked for.
+      linked = os.path.samestat(stat, target_stat)
+      if linked and image_copy == "hardlink":
+        return None, None, 0, stat.st_size
+      # Files of different sizes can't have the same content, no need to hash
+      old = hash_file(target) if target_stat.st_size == stat.st_size else ""
+    new = hash_file(source)
+    if old == new and image_copy != "hardlink" and not linked:
+      return old, new, 0, stat.st_size
+
+    ensure_dir(target)
+    fd, temp_path = tempfile.mkstemp(prefix="." + os.path.basename(target) + ".",
+                                     dir=os.path.dirname(target))
+    try:
+      if image_copy == "hardlink":
+        os.close(fd)
+        os.remove(temp_path)
+        os.link(source, temp_path)
+      else:
+        with os.fdopen(fd, "wb") as handle, open(source, "rb") as source_handle:
+          copy_data(source_handle, handle, stat.st_size)
+        os.chmod(temp_path, 0666 & ~umask if old is None else target_stat.st_mode & 0777)
+      os.rename(temp_path, target)
+    except:
+      remove_file(temp_path)
+      raise
+    return old, new, stat.st_size, 0
+
+  def save(self, path, data):
+    # The chunks are compared to the existing file as they come, the whole
+    # content is never held in memory.
+    try:
+      existing = open(path, "rb")
+    except IOError, e:
+      if e.errno != errno.ENOENT:
+        raise
+      existing = None
+
+    output = temp_path = None
+    try:
+      offset = size = 0
+      new = hashlib.sha1()
+      for chunk in iter_chunks(data):
+        new.update(chunk)
+        size += len(chunk)
+        if output is None:
+          if existing is not None and existing.read(len(chunk)) == chunk:
+            offset += len(chunk)
+            continue
+          # The content differs from here on, what came before is taken over
+          # from the existing file.
+          output, temp_path = create_temp_file(path)
+          if offset:
+            copy_prefix(existing, output, offset)
+        output.write(chunk)
+
+      if output is None:
+        if existing is not None and not existing.read(1):
+          return None
+        output, temp_path = create_temp_file(path)
+        if offset:
+          copy_prefix(existing, output, offset)
+      output.close()
+
+      if existing is not None:
+        existing.seek(0)
+        old = hashlib.sha1()
+        for block in iter(lambda: existing.read(1024 * 1024), ""):
+          old.update(block)
+        old, mode = old.hexdigest(), os.fstat(existing.fileno()).st_mode & 0777
+      else:
+        old, mode = None, None
+      commit_temp_file(temp_path, path, mode)
+    except:
+      if temp_path is not None:
+        remove_file(temp_path)
+      raise
+    finally:
+      if output is not None:
+        output.close()
+      if existing is not None:
+        existing.close()
+
+    return old, new.hexdigest(), size
+
+  def close(self):
+    pass
+
+  def abort(self):
+    pass
+
+# Where all outputs go, replaced by an ArchiveSink with --archive
+output_sink = DirectorySink()
+
+def iter_chunks(data):
+  if isinstance(data, basestring):
+    data = (data,)
+  for chunk in data:
+    yield chunk.encode("utf-8") if isinstance(chunk, unicode) else chunk
+
+class MemorySink(object):
+  """
+  Keeps the outputs in memory, mapping their paths to their content. Worker
+  processes use this to hand their outputs over to an archive in the parent
+  process, it is also handy to look at the outputs of a conversion from Python.
+  """
+  incremental = False
+
+  def __init__(self):
+    self.files = OrderedDict()
+
+  def copy(self, source, target):
+    with open(source, "rb") as handle:
+      old, new, size = self.save(target, handle.read())
+    return old, new, size, 0
+
+  def save(self, path, data):
+    buffer = cStringIO.StringIO()
+    for chunk in iter_chunks(data):
+      buffer.write(chunk)
+    data = buffer.getvalue()
+    old = self.files.get(path)
+    self.files[path] = data
+    return (hashlib.sha1(old).hexdigest() if old is not None else None,
+            hashlib.sha1(data).hexdigest(), len(data))
+
+  def close(self):
+    pass
+
+  def abort(self):
+    pass
+
+class ArchiveSink(object):
+  """
+  Writes the outputs into a tar or zip archive in one pass, the format is
+  chosen by the file extension. Paths in the archive are relative to the
+  output directory. The archive is only moved into place once it's complete.
+  """
+  incremental = False
+  spool_size = 1024 * 1024
+  tar_modes = ((".tar", "w|"), (".tar.gz", "w|gz"), (".tgz", "w|gz"), (".tar.bz2", "w|bz2"))
+
+  def __init__(self, path):
+    self.path = path
+    self.mtime = int(time.time())
+    # Images are copied on several threads
+    self.lock = threading.Lock()
+    self.handle, self.temp_path = create_temp_file(path)
+    try:
+      if path.endswith(".zip"):
+        self.zip = zipfile.ZipFile(self.handle, "w", zipfile.ZIP_DEFLATED, allowZip64=True)
+      else:
+        self.zip = None
+        mode = [mode for extension, mode in self.tar_modes if path.endswith(extension)][0]
+        self.tar = tarfile.open(fileobj=self.handle, mode=mode)
+    except:
+      self.handle.close()
+      remove_file(self.temp_path)
+      raise
+
+  @classmethod
+  def supports(cls, path):
+    return any(path.endswith(extension) for extension, mode in cls.tar_modes + ((".zip", None),))
+
+  def add(self, path, handle, size, compress=True):
+    name = os.path.relpath(path, output_dir)
+    with self.lock:
+      if self.zip is not None:
+        info = zipfile.ZipInfo(name, time.localtime(self.mtime)[:6])
+        info.compress_type = zipfile.ZIP_DEFLATED if compress else zipfile.ZIP_STORED
+        info.external_attr = (0100000 | (0666 & ~umask)) << 16
+        self.zip.writestr(info, handle.read())
+      else:
+        info = tarfile.TarInfo(name)
+        info.size = size
+        info.mtime = self.mtime
+        info.mode = 0666 & ~umask
+        self.tar.addfile(info, handle)
+
+  def copy(self, source, target):
+    new = hash_file(source)
+    size = os.path.getsize(source)
+    with open(source, "rb") as handle:
+      # Images are compressed already, deflating them gains nothing
+      self.add(target, handle, size, compress=False)
+    return None, new, size, 0
+
+  def add_file(self, path, source, size):
+    if self.zip is None:
+      with open(source, "rb") as handle:
+        self.add(path, handle, size)
+      return
+    # zipfile only streams files on disk, the entry gets their metadata
+    os.chmod(source, 0666 & ~umask)
+    os.utime(source, (self.mtime, self.mtime))
+    with self.lock:
+      self.zip.write(source, os.path.relpath(path, output_dir), zipfile.ZIP_DEFLATED)
+
+  def save(self, path, data):
+    # Both formats put the size before the content. Small files are joined in
+    # memory, once the chunks exceed spool_size they go to a temporary file.
+    digest = hashlib.sha1()
+    chunks = []
+    size = 0
+    spool = None
+    try:
+      for chunk in iter_chunks(data):
+        digest.update(chunk)
+        size += len(chunk)
+        if spool is not None:
+          spool[0].write(chunk)
+          continue
+        chunks.append(chunk)
+        if size > self.spool_size:
+          spool = create_temp_file(self.path)
+          spool[0].writelines(chunks)
+          del chunks[:]
+      if spool is None:
+        self.add(path, StringIO.StringIO("".join(chunks)), size)
+      else:
+        spool[0].close()
+        self.add_file(path, spool[1], size)
+    finally:
+      if spool is not None:
+        spool[0].close()
+        remove_file(spool[1])
+    return None, digest.hexdigest(), size
+
+  def finish(self):
+    if self.zip is not None:
+      self.zip.close()
+    else:
+      self.tar.close()
+    self.handle.close()
+
+  def close(self):
+    self.finish()
+    commit_temp_file(self.temp_path, self.path)
+
+  def abort(self):
+    # The archive is finished all the same, otherwise it would try again when
+    # it's collected, writing to a closed file
+    try:
+      self.finish()
+    except Exception:
+      pass
+    remove_file(self.temp_path)
+
+def copy_file(source, target):
+  """Copies an input file to the output sink. Returns the hashes of the
+  previous and the new content of the target along with the number of bytes
+  copied and skipped because the target was current."""
+  return output_sink.copy(source, target)
+
+@traced("save")
+def save_file(path, data):
+  """Writes an output file to the output sink, the data is a string or an
+  iterable of chunks."""
+  written_files.append(path)
+  result = output_sink.save(path, data)
+  if result is not None:
+    old, new, size = result
+    record_change(path, old, new)
+    trace_count("bytes", size)
+
+def is_selected(path):
+  """Checks whether an output belongs to the selected locales"""
+  parts = os.path.relpath(path, output_dir).split(os.sep)
+  return selected_locales is None or parts[0] != "locales" or parts[1] in selected_locales
+
+def save_locale(path, data):
+  if not is_selected(path):
+    return
+  trace_count("strings", len(data))
+  save_file(path, json.dumps(data, ensure_ascii=False, indent=2, separators=(',', ': ')))
+
+def iter_template_json(value, level=0):
+  """Yields the chunks of json.dumps(value, indent=2, separators=(',', ': '))
+  except for strings wrapped in $ signs, these are template expressions and
+  come out as they are, without the quotes and $ signs."""
+  if isinstance(value, basestring):
+    if len(value) >= 2 and value.startswith("$") and value.endswith("$"):
+      yield value[1:-1]
+    else:
+      yield json.dumps(value)
+  elif isinstance(value, (dict, list, tuple)):
+    if not value:
+      yield "{}" if isinstance(value, dict) else "[]"
+      return
+    opening, closing = "{}" if isinstance(value, dict) else "[]"
+    indent = "\n" + "  " * (level + 1)
+    for i, item in enumerate(value.iteritems() if isinstance(value, dict) else value):
+      yield (opening if i == 0 else ",") + indent
+      if isinstance(value, dict):
+        key, item = item
+        for chunk in iter_template_json(key, level + 1):
+          yield chunk
+        yield ": "
+      for chunk in iter_template_json(item, level + 1):
+        yield chunk
+    yield "\n" + "  " * level + closing
+  else:
+    yield json.dumps(value)
 
 def get_text(node):
   result = []
   for child in node.childNodes:
     if child.nodeType != Node.TEXT_NODE:
-      print child.tagName
       raise Exception("Unexpected node type %s." % [
         "ELEMENT_NODE", "ATTRIBUTE_NODE", "TEXT_NODE", "CDATA_SECTION_NODE",
         "ENTITY_REFERENCE_NODE", "ENTITY_NODE", "PROCESSING_INSTRUCTION_NODE",
         "COMMENT_NODE", "DOCUMENT_NODE", "DOCUMENT_TYPE_NODE",
         "DOCUMENT_FRAGMENT_NODE", "NOTATION_NODE"
-      ][child.nodeType])
+      ][child.nodeType - 1])
 
     result.append(child.nodeValue)
   return "".join(result)
@@ -133,152 +1305,423 @@ def get_element(node, tagName, *args):
         return child
   return None
 
+class ElementIndex(object):
+  """
+  The first child element of every element by tag name, collected in one walk
+  of the document, along with the stripped texts looked up. get() and
+  get_text() work like get_element() and get_text().strip() but don't scan the
+  children again for every lookup. The contents of anwv elements aren't
+  indexed, they hold page content rather than structure.
+  """
+  def __init__(self, document):
+    # Keys are node ids, the document keeps the nodes and thereby ids alive
+    self.document = document
+    self._children = {}
+    self._texts = {}
+    stack = [document]
+    while stack:
+      node = stack.pop()
+      for child in node.childNodes:
+        if child.nodeType == Node.ELEMENT_NODE:
+          self._children.setdefault((id(node), child.tagName), child)
+          if child.tagName != "anwv":
+            stack.append(child)
+
+  def get(self, node, *path):
+    for tagName in path:
+      node = self._children.get((id(node), tagName))
+      if node is None:
+        return None
+    return node
+
+  def get_text(self, node, *path):
+    key = (id(node),) + path
+    if key not in self._texts:
+      self._texts[key] = get_text(self.get(node, *path)).strip()
+    return self._texts[key]
+
+@traced("extract_string")
 def extract_string(strings, property, *element_selector):
   element = get_element(*element_selector) if len(element_selector) > 1 else element_selector[0]
   text = get_text(element).strip()
   if text and "[untr]" not in text:
     strings[property] = {"message": text}
 
+class AlignedNode(object):
+  """
+  A node of the en document together with the nodes found at the same position
+  in the other locales. values is indexed like locales, with en always coming
+  first. Text nodes are stored as their text, None marks locales which don't
+  have a node at this position. counts holds the number of children each
+  locale had when they were aligned.
+  """
+  __slots__ = ("locales", "node", "values", "_children", "counts")
+
+  def __init__(self, locales, node, values):
+    self.locales = locales
+    self.node = node
+    self.values = values
+    self._children = None
+    self.counts = None
+
+  @property
+  def children(self):
+    if self._children is None:
+      locale_children = [value.childNodes if value is not None and
+                             not isinstance(value, basestring) else ()
+                         for value in self.values]
+      self.counts = map(len, locale_children)
+      self._children = [
+        AlignedNode(self.locales, child, [
+          get_value(children[i]) if i < len(children) else None
+          for children in locale_children
+        ])
+        for i, child in enumerate(self.node.childNodes)
+      ]
+    return self._children
+
+def get_value(node):
+  return node.nodeValue if node.nodeType == Node.TEXT_NODE else node
+
+def get_value_text(value):
+  return value if isinstance(value, basestring) else value.nodeValue or ""
+
+def align(nodes):
+  locales = ("en",) + tuple(sorted(locale for locale in nodes if locale != "en"))
+  return AlignedNode(locales, nodes["en"], [
+    get_value(nodes[locale]) if nodes[locale] is not None else None
+    for locale in locales
+  ])
+
 def squash_attrs(node):
-  if node.nodeType == Node.ELEMENT_NODE:
-    for child in list(node.childNodes):
+  element = node.node
+  if element.nodeType == Node.ELEMENT_NODE:
+    for child in list(element.childNodes):
       if child.nodeType == Node.ELEMENT_NODE and child.tagName == "attr":
-        node.setAttribute(child.getAttribute("name"), get_text(child))
-        node.removeChild(child)
+        element.setAttribute(child.getAttribute("name"), get_text(child))
+        element.removeChild(child)
   return node
 
-def merge_children(nodes):
-  def is_fixed(node):
-    return (node.nodeType == Node.ELEMENT_NODE and
-        node.tagName == "fix" and
-        len(node.childNodes) and
-        all(n.nodeType == Node.TEXT_NODE for n in node.childNodes) and
-        any(re.search(r"[\w@]+", n.nodeValue) for n in node.childNodes))
-
-  def is_text(node):
-    if node.nodeType == Node.TEXT_NODE or is_fixed(node):
-      return True
-    if (node.nodeType == Node.ELEMENT_NODE and
-        node.tagName in tag_whitelist and
-        all(n.nodeType == Node.TEXT_NODE or is_fixed(n) for n in node.childNodes)):
-      return True
-    return False
-
-  def is_empty(node):
-    return node.nodeType == Node.TEXT_NODE and not node.nodeValue.strip()
-
-  def serializeContents(nodes):
-    result = []
-    for node in nodes:
-      if node.nodeType == Node.TEXT_NODE:
-        result.append(node.nodeValue.replace("<", "&lt;").replace(">", "&gt;"))
-      else:
-        if node.childNodes:
-          opening = node.cloneNode(False).toxml().replace("/>", ">")
+def is_fixed(node):
+  return (node.nodeType == Node.ELEMENT_NODE and
+      node.tagName == "fix" and
+      len(node.childNodes) and
+      all(n.nodeType == Node.TEXT_NODE for n in node.childNodes) and
+      any(fixed_text_regexp.search(n.nodeValue) for n in node.childNodes))
+
+fixed_text_regexp = re.compile(r"[\w@]")
+
+def is_text(node):
+  if node.nodeType == Node.TEXT_NODE or is_fixed(node):
+    return True
+  if (node.nodeType == Node.ELEMENT_NODE and
+      node.tagName in tag_whitelist and
+      all(n.nodeType == Node.TEXT_NODE or is_fixed(n) for n in node.childNodes)):
+    return True
+  return False
+
+def is_empty(value):
+  return value is None or (isinstance(value, basestring) and not value.strip())
+
+def is_link(node):
+  return node.nodeType == Node.ELEMENT_NODE and node.tagName == "a"
+
+def get_attributes(element):
+  """Returns the attributes of a light or minidom element, sorted like toxml()"""
+  if isinstance(element, LightElement):
+    return sorted(element._attrs.iteritems()) if element._attrs else []
+  return sorted(element.attributes.items())
+
+def serialize_contents(nodes):
+  result = []
+  for node in nodes:
+    if isinstance(node, basestring):
+      result.append(node.replace("<", "&lt;").replace(">", "&gt;"))
+    elif node.nodeType == Node.TEXT_NODE:
+      result.append(node.nodeValue.replace("<", "&lt;").replace(">", "&gt;"))
+    elif node.nodeType == Node.ELEMENT_NODE:
+      opening = "<" + node.tagName + "".join(' %s="%s"' % (name, escape_xml(value))
+                                             for name, value in get_attributes(node))
+      if node.childNodes:
+        opening += ">"
+        if "\n" in opening:
+          # Keep the closing tag this used to produce for multi-line attributes
           closing = re.sub(r"\s.*>", ">", opening).replace("<", "</")
-          result.append(opening)
-          result.append(serializeContents(node.childNodes))
-          result.append(closing)
         else:
-          result.append(node.toxml())
+          closing = "</%s>" % node.tagName
+        result.append(opening)
+        result.append(serialize_contents(node.childNodes))
+        result.append(closing)
+      else:
+        result.append(opening + "/>")
+    else:
+      result.append(node.toxml())
 
-    return "".join(result)
+  return "".join(result)
 
-  i = 0
-  en = nodes["en"]
-  if all(is_empty(n) or not is_text(n) or (n.nodeType == Node.ELEMENT_NODE and n.tagName == "a") for n in en.childNodes):
+def set_child_nodes(element, nodes):
+  """Replaces all children of a DOM element in one go"""
+  element.childNodes[:] = nodes
+  if isinstance(element, LightNode):
+    for node in nodes:
+      node.parentNode = element
+  else:
+    # minidom also keeps track of siblings
+    previous = None
+    for node in nodes:
+      node.parentNode = element
+      node.previousSibling = previous
+      if previous is not None:
+        previous.nextSibling = node
+      previous = node
+    if previous is not None:
+      previous.nextSibling = None
+
+def merge_children(parent):
+  """
+  Merges runs of text and inline elements into single text nodes, building the
+  new list of children in one pass.
+  """
+  children = parent.children
+  text = map(is_text, (child.node for child in children))
+  if all(not child_is_text or is_empty(child.values[0]) or is_link(child.node)
+         for child, child_is_text in itertools.izip(children, text)):
     return
 
-  start = None
+  en = parent.node
+  counts = parent.counts
+  truncated = [False] * len(counts)
+  result = []
   i = 0
-  while i <= len(en.childNodes):
-    if start == None:
-      if i < len(en.childNodes) and is_text(en.childNodes[i]):
-        start = i
-    elif i >= len(en.childNodes) or not is_text(en.childNodes[i]):
-      end = i - 1
-      while start < end and all(is_empty(node.childNodes[start]) for node in nodes.itervalues()):
-        start += 1
-      while start < end and all(is_empty(node.childNodes[end]) for node in nodes.itervalues()):
-        end -= 1
-      if start < end:
-        for locale, parent in nodes.iteritems():
-          if end < len(parent.childNodes):
-            node = parent.ownerDocument.createTextNode(serializeContents(parent.childNodes[start:end+1]))
-            parent.replaceChild(node, parent.childNodes[start])
-            for child in parent.childNodes[start+1:end+1]:
-              parent.removeChild(child)
-          else:
-            while start < len(parent.childNodes):
-              parent.removeChild(parent.childNodes[start])
-        i -= end - start
-      start = None
-    i += 1
-
-def process_body(nodes, strings, prefix="", counter=1):
-  if nodes["en"].nodeType == Node.ELEMENT_NODE:
-    if nodes["en"].tagName not in ("style", "script", "fix", "pre"):
-      for i in range(len(nodes["en"].childNodes)):
-        node = nodes["en"].childNodes[i]
-        if (node.nodeType == Node.ELEMENT_NODE and node.tagName == "a" and
-            not node.hasAttribute("href") and get_element(node, "attr") and
-            get_element(node, "attr").getAttribute("name") == "href"):
-          # Process href attribute earlier for translatable links
-          string_key = prefix + "s%i" % counter
-          for locale, value in nodes.iteritems():
-            attr = get_element(value.childNodes[i], "attr")
-            text = get_text(attr).strip()
-            attr.parentNode.setAttribute("href", "{{%s %s}}" % (string_key, text))
-            attr.parentNode.removeChild(attr)
-            if locale != "en" and "[untr]" not in text:
-              strings[locale][string_key] = {"message": text}
-          counter += 1
-
-      merge_children(nodes)
-      for i in range(len(nodes["en"].childNodes)):
-        new_nodes = {}
-        for locale, value in nodes.iteritems():
-          if len(value.childNodes) > i:
-            new_nodes[locale] = value.childNodes[i]
-        counter = process_body(new_nodes, strings, prefix, counter)
-    squash_attrs(nodes["en"])
-  elif nodes["en"].nodeType == Node.TEXT_NODE:
-    if any(n.nodeValue.strip() for n in nodes.itervalues()):
-      message = nodes["en"].nodeValue.strip()
-      message = re.sub(r'\s+--(?!>)', u'\u00A0\u2014', message)
-      message = message.replace(u'\u00AB ', u'\u00AB\u00A0').replace(u' \u00BB', u'\u00A0\u00BB')
-      string_key = prefix + "s%i" % counter
+  while i < len(children):
+    if not text[i]:
+      result.append(children[i])
+      i += 1
+      continue
 
-      for locale, value in nodes.iteritems():
-        text = value.nodeValue or ""
-        text = re.sub(r'\s+--(?!>)', u'\u00A0\u2014', text)
-        text = text.replace(u'\u00AB ', u'\u00AB\u00A0').replace(u' \u00BB', u'\u00A0\u00BB')
-        pre, text, post = re.search(r"^(\s*)(.*?)(\s*)$", text, re.S).groups()
-        if string_key == prefix + "s%i" % counter and text and "[untr]" not in text:
-          text = re.sub("\n\s+", " ", text, flags=re.S)
-          if locale != "en":
-            def replace_fixed(match):
-              fixed_count[0] += 1
-              return "{%d}" % fixed_count[0]
-
-            fixed_count = [0]
-            text = re.sub(r"<fix>.*?</fix>", replace_fixed, text, flags=re.S)
-            text, _ = attribute_parser.parse(text, "")
-            strings[locale][string_key] = {"message": text}
-        value.nodeValue = "%s{{%s %s}}%s" % (pre, string_key, message + (" " if message.endswith("}") else ""), post)
+    run_end = i
+    while run_end < len(children) and text[run_end]:
+      run_end += 1
+    start = i
+    end = run_end - 1
+    while start < end and all(is_empty(value) for value in children[start].values):
+      start += 1
+    while start < end and all(is_empty(value) for value in children[end].values):
+      end -= 1
+
+    if start < end:
+      result.extend(children[i:start])
+      values = []
+      for j, count in enumerate(counts):
+        if not truncated[j] and end < count:
+          values.append(serialize_contents(child.values[j] for child in children[start:end+1]))
+        else:
+          # The locale doesn't have all the nodes, drop the remaining ones
+          values.append(None)
+          if not truncated[j]:
+            truncated[j] = True
+            for child in children[end+1:]:
+              child.values[j] = None
+      node = en.ownerDocument.createTextNode(values[0])
+      result.append(AlignedNode(parent.locales, node, values))
+      result.extend(children[end+1:run_end])
+    else:
+      result.extend(children[i:run_end])
+    i = run_end
+
+  if len(result) != len(children):
+    parent._children = result
+    set_child_nodes(en, [child.node for child in result])
+
+def process_links(node, strings, prefix, counter):
+  for child in node.children:
+    if (child.node.nodeType == Node.ELEMENT_NODE and child.node.tagName == "a" and
+        not child.node.hasAttribute("href") and get_element(child.node, "attr") and
+        get_element(child.node, "attr").getAttribute("name") == "href"):
+      # Process href attribute earlier for translatable links
+      string_key = prefix + "s%i" % counter
+      for locale, value in itertools.izip(node.locales, child.values):
+        if value is None:
+          continue
+        attr = get_element(value, "attr")
+        text = get_text(attr).strip()
+        attr.parentNode.setAttribute("href", "{{%s %s}}" % (string_key, text))
+        attr.parentNode.removeChild(attr)
+        if locale != "en" and "[untr]" not in text:
+          strings[locale][string_key] = {"message": text}
       counter += 1
-  elif nodes["en"].nodeType == Node.COMMENT_NODE:
-    pass
-  else:
-    print >>sys.stderr, "Unexpected node type %i" % nodes["en"].nodeType
+  return counter
 
+def process_text(node, strings, prefix, counter):
+  if any(get_value_text(value).strip() for value in node.values if value is not None):
+    message = node.values[0].strip()
+    message = re.sub(r'\s+--(?!>)', u'\u00A0\u2014', message)
+    message = message.replace(u'\u00AB ', u'\u00AB\u00A0').replace(u' \u00BB', u'\u00A0\u00BB')
+    string_key = prefix + "s%i" % counter
+
+    for locale, value in itertools.izip(node.locales, node.values):
+      if value is None:
+        continue
+      text = get_value_text(value)
+      text = re.sub(r'\s+--(?!>)', u'\u00A0\u2014', text)
+      text = text.replace(u'\u00AB ', u'\u00AB\u00A0').replace(u' \u00BB', u'\u00A0\u00BB')
+      pre, text, post = re.search(r"^(\s*)(.*?)(\s*)$", text, re.S).groups()
+      if text and "[untr]" not in text:
+        text = re.sub("\n\s+", " ", text, flags=re.S)
+        if locale != "en":
+          def replace_fixed(match):
+            fixed_count[0] += 1
+            return "{%d}" % fixed_count[0]
+
+          fixed_count = [0]
+          text = re.sub(r"<fix>.*?</fix>", replace_fixed, text, flags=re.S)
+          text, _ = attribute_parser.parse(text, "")
+          strings[locale][string_key] = {"message": text}
+      if locale == "en":
+        node.node.nodeValue = "%s{{%s %s}}%s" % (pre, string_key, message + (" " if message.endswith("}") else ""), post)
+    counter += 1
   return counter
 
-def xml_to_text(xml, strings=None):
-  def unescape(match):
-    return '{{%s %s}}' % (match.group(1), h.unescape(match.group(3)))
+@traced("process_body")
+def process_body(node, strings, prefix="", counter=1):
+  # Walk the tree with an explicit stack, deep documents would otherwise hit
+  # the recursion limit. Elements are visited twice, squash_attrs() runs once
+  # all their children have been processed.
+  stack = [(node, False)]
+  nodes = 0
+  while stack:
+    node, visited = stack.pop()
+    en = node.node
+    if visited:
+      squash_attrs(node)
+      node._children = None
+      continue
+
+    nodes += 1
+    if en.nodeType == Node.ELEMENT_NODE:
+      stack.append((node, True))
+      if en.tagName not in ("style", "script", "fix", "pre"):
+        counter = process_links(node, strings, prefix, counter)
+        merge_children(node)
+        stack.extend((child, False) for child in reversed(node.children))
+    elif en.nodeType == Node.TEXT_NODE:
+      counter = process_text(node, strings, prefix, counter)
+    elif en.nodeType == Node.COMMENT_NODE:
+      pass
+    else:
+      print >>sys.stderr, "Unexpected node type %i" % en.nodeType
+
+  trace_count("nodes", nodes)
+  return counter
+
+# Wrapper tags which are removed from the output, along with their closing tags
+dropped_tags = ("fix", "anwv", "notoc")
+void_tag_regexp = re.compile(r"(?:link|meta|br|col|base|img|param|area|hr|input)\b")
+
+# <script src=""/> => <script src=""></script>
+self_closing_regexp = re.compile(r'<((?!link\b|meta\b|br\b|col\b|base\b|img\b|param\b|area\b|hr\b|input\b)([\w:]+)\b[^<>]*)/>', re.S)
+
+# <img src="foo">dummy</img> => <img src="foo">
+void_content_regexp = re.compile(r'<((link|meta|br|col|base|img|param|area|hr|input)\b[^<>]*)>([^<>]*)</\2>', re.S)
+
+def fix_markup(text):
+  # Markup only shows up in text once translatable strings are unescaped, the
+  # same fix-ups as for the elements themselves apply to it then.
+  text = re.sub(r"</?anwv/?>", "", text)
+  text = re.sub(r"</?notoc/?>", "", text)
+  text = self_closing_regexp.sub(r"<\1></\2>", text)
+  text = text.replace("/>", ">")
+  return void_content_regexp.sub(r"<\1>", text)
+
+class HTMLWriter(object):
+  """
+  Collects the output of write_html(), replacing tabs with spaces and removing
+  trailing spaces as lines are completed.
+  """
+  def __init__(self, tabstop=8):
+    self.tabstop = tabstop
+    self.lines = []
+    self.line = []
+    # Tab positions are counted before expansion, offset accumulates them
+    # as the old translate_tabs() did
+    self.column = 0
+    self.offset = 0
+
+  def write(self, text):
+    if "\n" not in text and "\t" not in text:
+      self.line.append(text)
+      self.column += len(text)
+      return
+
+    for i, segment in enumerate(text.split("\n")):
+      if i:
+        self.lines.append("".join(self.line).rstrip(" "))
+        self.line = []
+        self.column = 0
+        self.offset = 0
+      for j, part in enumerate(segment.split("\t")):
+        if j:
+          self.offset += self.column
+          self.line.append(" " * (self.tabstop - self.offset % self.tabstop))
+          self.column += 1
+        self.line.append(part)
+        self.column += len(part)
+
+  def getvalue(self):
+    return "\n".join(self.lines + ["".join(self.line)])
+
+def write_html(nodes, write, process_strings):
+  """
+  Writes nodes in their final HTML form: void elements without closing tags,
+  other elements never self-closing, wrapper tags dropped. Text and attribute
+  values are passed through process_strings() in document order.
+  """
+  stack = list(reversed(nodes))
+  while stack:
+    node = stack.pop()
+    if isinstance(node, basestring):
+      write(node)
+    elif node.nodeType == Node.TEXT_NODE:
+      text = process_strings(escape_xml(node.nodeValue))
+      if "<" in text or ">" in text:
+        text = fix_markup(text)
+      write(text)
+    elif node.nodeType == Node.ELEMENT_NODE:
+      tag = node.tagName
+      attributes = get_attributes(node)
+      if tag in dropped_tags and not attributes:
+        stack.extend(reversed(node.childNodes))
+        continue
 
-  def rename_links(match):
+      attributes = "".join(' %s="%s"' % (name, process_strings(escape_xml(value)))
+                           for name, value in attributes)
+      closing = "" if tag in dropped_tags else "</%s>" % tag
+      if "<" in attributes or ">" in attributes:
+        # Unescaped strings in attribute values, fix up the element as a whole
+        if node.childNodes:
+          content = []
+          write_html(node.childNodes, content.append, process_strings)
+          write(fix_markup("<%s%s>%s%s" % (tag, attributes, "".join(content), closing)))
+        else:
+          write(fix_markup("<%s%s/>" % (tag, attributes)))
+      elif not node.childNodes:
+        write(self_closing_regexp.sub(r"<\1></\2>", "<%s%s/>" % (tag, attributes)).replace("/>", ">"))
+      elif void_tag_regexp.match(tag):
+        content = []
+        write_html(node.childNodes, content.append, process_strings)
+        write(void_content_regexp.sub(r"<\1>", "<%s%s>%s%s" % (tag, attributes, "".join(content), closing)))
+      else:
+        write("<%s%s>" % (tag, attributes))
+        stack.append(closing)
+        stack.extend(reversed(node.childNodes))
+    else:
+      # Comments, CDATA sections and processing instructions
+      text = re.sub(r"</?fix/?>", "", node.toxml())
+      write(fix_markup(process_strings(text)))
+
+@traced("xml_to_text")
+def xml_to_text(xml, strings=None):
+  def rename_links(parent_key, text):
     def rename_link(match):
       key, url = match.groups()
       new_key = parent_key + "-link" + (str(counter.value) if counter.value > 1 else "")
@@ -291,74 +1734,60 @@ def xml_to_text(xml, strings=None):
 
     counter = lambda: None
     counter.value = 1
-    parent_key = match.group(1)
-    text = re.sub(r'href="{{(\S+) (\S+)}}"', rename_link, match.group(3))
-    return '{{%s %s}}' % (parent_key, text)
-
-  result = xml.toxml()
-
-  if strings:
-    # Merge duplicate strings
-    candidates = {}
-    def find_duplicates(match):
-      key = match.group(1)
-      text = re.sub(r"<fix>.*?</fix>", '{1}', h.unescape(match.group(3)), flags=re.S)
-      text, _ = attribute_parser.parse(text, "")
-      text = {"_default": text}
-      for locale in strings.iterkeys():
-        if key in strings[locale]:
-          text[locale] = strings[locale][key]["message"]
-      existing = [k for k, v in candidates.iteritems() if v == text]
-      if existing and len(text["_default"]) >= 8:
-        for locale in text.iterkeys():
-          if locale != "_default":
-            del strings[locale][key]
-        return "{{%s %s}}" % (existing[0], match.group(3))
-      else:
-        candidates[key] = text
-        return match.group(0)
-
-    result = re.sub(string_regexp, find_duplicates, result, flags=re.S)
-
-  result = re.sub(r"</?fix/?>", "", result, flags=re.S)
-
-  result = re.sub(string_regexp, unescape, result, flags=re.S)
-  if strings:
-    result = re.sub(string_regexp, rename_links, result, flags=re.S)
-
-  result = re.sub(r"</?anwv/?>", "", result)
-  result = re.sub(r"</?notoc/?>", "", result)
-  result = result.replace("/_override-static/global/global", "")
-
-  # <script src=""/> => <script src=""></script>
-  result = re.sub(r'<((?!link\b|meta\b|br\b|col\b|base\b|img\b|param\b|area\b|hr\b|input\b)([\w:]+)\b[^<>]*)/>', r'<\1></\2>', result, flags=re.S)
-
-  # <img src="foo"/> => <img src="foo">
-  result = re.sub(r'\/>', r'>', result)
-
-  # <img src="foo">dummy</img> => <img src="foo">
-  result = re.sub(r'<((link|meta|br|col|base|img|param|area|hr|input)\b[^<>]*)>([^<>]*)</\2>', r'<\1>', result, flags=re.S)
-
-  def translate_tabs(tabstop = 8):
-    offset = [0]
-    def replace(match, offset=offset):
-      offset[0] += match.start(0)
-      return " " * (tabstop - offset[0] % tabstop)
-    return replace
-
-  # Remove some trailing whitespace and replace tabs with spaces
-  result = "\n".join([re.sub(r'\t', translate_tabs(8), s) for s in result.split("\n")])
-  result = re.sub(r'\ +\n', '\n', result, flags=re.S)
-
-  return result
-
+    return re.sub(r'href="{{(\S+) (\S+)}}"', rename_link, text)
+
+  # Merge duplicate strings, candidates are indexed by their text in all
+  # locales. Only strings of at least 8 characters are merged.
+  candidates = {}
+  candidate_texts = {}
+  def find_duplicate(key, message):
+    text = re.sub(r"<fix>.*?</fix>", '{1}', h.unescape(message), flags=re.S)
+    text, _ = attribute_parser.parse(text, "")
+    mergeable = len(text) >= 8
+    text = [("_default", text)]
+    for locale in strings.iterkeys():
+      if key in strings[locale]:
+        text.append((locale, strings[locale][key]["message"]))
+    text = tuple(sorted(text))
+    existing = candidates.get(text)
+    if existing is not None and mergeable:
+      for locale, value in text:
+        if locale != "_default":
+          del strings[locale][key]
+      return existing
+    else:
+      if candidates.get(candidate_texts.get(key)) == key:
+        del candidates[candidate_texts[key]]
+      candidates.setdefault(text, key)
+      candidate_texts[key] = text
+      return key
+
+  def process_string(key, message):
+    # Deduplication, unescaping and link renaming share a single scan
+    if strings:
+      key = find_duplicate(key, message)
+    message = h.unescape(message)
+    if strings and 'href="{{' in message:
+      message = rename_links(key, message)
+    return "{{%s %s}}" % (key, message)
+
+  def process_strings(text):
+    if "{{" in text:
+      text = replace_strings(text, process_string)
+    return text.replace("/_override-static/global/global", "")
+
+  writer = HTMLWriter()
+  write_html([xml], writer.write, process_strings)
+  return writer.getvalue()
+
+@traced("raw_to_template")
 def raw_to_template(text):
   # {{s1 Hello World}} => {{"Hello World"|translate("s1")}}
   def escape_string(s):
     return s.replace("\\", "\\\\").replace('"', '\\"').replace("\r", "\\r").replace("\n", "\\n")
-  def convert_translatable_strings(match):
-    return '{{"%s"|translate("%s")}}' % (escape_string(h.unescape(match.group(3))), match.group(1))
-  text = re.sub(string_regexp, convert_translatable_strings, text, flags=re.S)
+  def convert_translatable_string(key, message):
+    return '{{"%s"|translate("%s")}}' % (escape_string(h.unescape(message)), key)
+  text = replace_strings(text, convert_translatable_string)
 
   # <anwtoc page="en/android-faq" titletag="h2"></anwtoc> => {{toc("android-faq", "h2")}}
   def convert_toc(match):
@@ -388,9 +1817,7 @@ def process_page(path, menu):
 
   data = {}
   strings = {}
-  for locale in locales:
-    if not os.path.exists(format % locale):
-      continue
+  for locale in get_input_locales(format):
     data[locale] = read_xml(format % locale)
     strings[locale] = OrderedDict()
 
@@ -403,7 +1830,7 @@ def process_page(path, menu):
   bodies = {}
   for locale, value in data.iteritems():
     bodies[locale] = get_element(value.documentElement, "body", "anwv")
-  process_body(bodies, strings)
+  process_body(align(bodies), strings)
 
   body = xml_to_text(bodies["en"], strings)
   head = xml_to_text(get_element(data["en"].documentElement, "head", "anwv"), strings)
@@ -416,59 +1843,124 @@ def process_page(path, menu):
   head = re.sub(r'src="/FilterClasses.jsm"', r'src="/js/filterClasses.js"', head)
   head = re.sub(r'(url\(&quot;/)((?:facebook|twitter|googleplus)\.png&quot;\))', r'\1img/\2', head)
 
+  # Head and body are written as separate chunks, not joined into one string
   if head:
-    pagedata = "<head>%s</head>%s" % (h.unescape(head), body)
-  else:
-    pagedata = body
+    head = h.unescape(head)
+  contains_toc = "<anwtoc" in head or "<anwtoc" in body
+  toc_pages = [match for part in (head, body)
+               for match in re.findall(r'<anwtoc page="(\w+)/([\w-]+)"', part)]
 
-  contains_toc = "<anwtoc" in pagedata
+  if pagename == "index" or contains_toc:
+    head = raw_to_template(head)
+    body = raw_to_template(body)
+  content = ["<head>", head, "</head>", body] if head else [body]
 
   if pagename == "index":
-    pagedata = license_header + "\n\n" + raw_to_template(pagedata)
+    content = [license_header, "\n\n"] + content
     variables.append("noheading=True")
     variables.append("localefile=index")
   elif contains_toc:
-    pagedata = (license_header + '\n\n{% from "includes/toc" import toc %}\n\n' +
-                raw_to_template(pagedata))
+    content = [license_header, '\n\n{% from "includes/toc" import toc %}\n\n'] + content
   elif pagename in ("acceptable-ads-manifesto", "share", "customize-youtube", "customize-facebook"):
     variables.append("template=minimal")
 
-  pagedata = "\n".join(variables) + "\n\n" + pagedata
-
   if pagename == "index":
     target = os.path.join(output_dir, "includes", pagename + ".tmpl")
   elif contains_toc:
     target = os.path.join(output_dir, "pages", pagename + ".tmpl")
   else:
     target = os.path.join(output_dir, "pages", pagename + ".html")
-  ensure_dir(target)
-  with codecs.open(target, "wb", encoding="utf-8") as handle:
-    handle.write(pagedata)
+  save_file(target, ["\n".join(variables), "\n\n"] + content)
+  for locale, name in toc_pages:
+    record_dependency(target, "%s/page!%s" % (locale, name))
+  if "<animation" in body:
+    record_dependency(target, "static/js/animation.js")
 
   for locale, value in strings.iteritems():
     if value:
       localefile = os.path.join(output_dir, "locales", locale, pagename + ".json")
       save_locale(localefile, value)
+  release_documents(path, data.itervalues())
 
-def process_image(path):
-  if path.split("/")[0] in locales:
-    target = os.path.join(output_dir, "locales", os.path.dirname(path), os.path.basename(path).replace("image!", ""))
+def get_image_copies(path):
+  """Returns the files to copy for an image, along with their targets, and the
+  sizes of the locale variants left out as duplicates. Images in en/ come with
+  their locale variants."""
+  filename = os.path.basename(path).replace("image!", "")
+  if path.startswith("en/"):
+    format = "%s/" + path.split("/", 1)[1]
+    sources = [format % locale for locale in get_input_locales(format)]
   else:
-    target = os.path.join(output_dir, "static", os.path.dirname(path), os.path.basename(path).replace("image!", ""))
-  with open(path, "rb") as handle:
-    data = handle.read()
+    sources = [path]
+
+  duplicates = []
+  if dedup_images and len(sources) > 1:
+    size = os.path.getsize(path)
+    original = None
+    for source in list(sources):
+      if source == path or os.path.getsize(source) != size:
+        continue
+      if original is None:
+        original = hash_file(path)
+      if hash_file(source) == original:
+        sources.remove(source)
+        duplicates.append(size)
+
+  copies = []
+  for source in sources:
+    if source.split("/")[0] in locales:
+      target = os.path.join(output_dir, "locales", os.path.dirname(source), filename)
+    else:
+      target = os.path.join(output_dir, "static", os.path.dirname(source), filename)
+    if is_selected(target):
+      copies.append((source, target))
+  return copies, duplicates
+
+def get_static_image(src):
+  """Returns the input file an image in the static directory is copied from,
+  for a path relative to the static directory or to images/ in it. None if no
+  input provides it."""
+  path = src.lstrip("/")
+  directory, filename = os.path.split(path)
+  for input in (os.path.join(directory, "image!" + filename),
+                os.path.join("images", directory, "image!" + filename)):
+    if input.startswith("images/") and input_exists(input):
+      return input
+  return None
 
-  ensure_dir(target)
-  with open(target, "wb") as handle:
-    handle.write(data)
+def record_duplicates(duplicates):
+  copy_stats["duplicates"] += len(duplicates)
+  copy_stats["saved"] += sum(duplicates)
 
-  if path.startswith("en/"):
-    for locale in locales:
-      if locale == "en":
-        continue
-      new_path = locale + path[2:]
-      if os.path.exists(new_path):
-        process_image(new_path)
+def copy_image_worker(path):
+  copies = []
+  duplicates = []
+  error = None
+  try:
+    sources, duplicates = get_image_copies(path)
+    for source, target in sources:
+      copies.append((target, copy_file(source, target)))
+  except Exception:
+    # Exceptions raised on the threads lose their traceback
+    if not keep_going:
+      raise Exception("Failed to copy %s:\n%s" % (path, traceback.format_exc()))
+    error = traceback.format_exc()
+  return path, copies, duplicates, error
+
+def process_images(paths):
+  """Copies the given images on a few threads, copying is mostly waiting for
+  the disk. Yields the same as process()."""
+  pool = multiprocessing.pool.ThreadPool(copy_threads)
+  try:
+    for path, copies, duplicates, error in pool.imap_unordered(copy_image_worker, paths):
+      for target, result in copies:
+        record_copy(target, *result)
+      record_duplicates(duplicates)
+      yield path, [target for target, result in copies], error
+    pool.close()
+  finally:
+    pool.terminate()
+    pool.join()
 
 def process_interface(path):
   pagename = os.path.join(os.path.dirname(path), os.path.basename(path).replace("interface!", ""))
@@ -477,35 +1969,36 @@ def process_interface(path):
 
   data = {}
   strings = {}
+  indexes = {}
 
-  for locale in locales:
-    if not os.path.exists(format % locale):
-      continue
+  for locale in get_input_locales(format):
     data[locale] = read_xml(format % locale)
     strings[locale] = OrderedDict()
+    indexes[locale] = ElementIndex(data[locale])
 
   # Store the methods and properties for the interface
   interface = {}
 
-  for property in get_element(data["en"].documentElement, "properties").childNodes:
-    property_name = get_text(get_element(property, "name", "anwv")).strip()
-    property_type = get_text(get_element(property, "type", "anwv")).strip()
-    property_modifier = get_text(get_element(property, "modifier", "anwv")).strip()
+  index = indexes["en"]
+  for property in index.get(data["en"].documentElement, "properties").childNodes:
+    property_name = index.get_text(property, "name", "anwv")
+    property_type = index.get_text(property, "type", "anwv")
+    property_modifier = index.get_text(property, "modifier", "anwv")
     property_key = " ".join([property_modifier, property_type, property_name]).strip()
 
     interface[property_key] = OrderedDict({
       "description": "$%sDescription$" % property_name
     })
 
-  for method in get_element(data["en"].documentElement, "methods").childNodes:
-    method_name = get_text(get_element(method, "name", "anwv")).strip()
-    method_return_type = get_text(get_element(method, "return_type", "anwv")).strip()
-    method_version = get_text(get_element(method, "version", "anwv")).strip()
+  for method in index.get(data["en"].documentElement, "methods").childNodes:
+    method_name = index.get_text(method, "name", "anwv")
+    method_return_type = index.get_text(method, "return_type", "anwv")
+    method_version = index.get_text(method, "version", "anwv")
     argument_string = ""
     argument_names = []
-    for argument in get_element(method, "arguments").childNodes:
-      argument_name = get_text(get_element(argument, "name", "anwv")).strip()
-      argument_type = get_text(get_element(argument, "type", "anwv")).strip()
+    for argument in index.get(method, "arguments").childNodes:
+      argument_name = index.get_text(argument, "name", "anwv")
+      argument_type = index.get_text(argument, "type", "anwv")
       argument_string += " %s %s," % (argument_type, argument_name)
       argument_names.append(argument_name)
     argument_string = argument_string.strip().strip(",")
@@ -531,85 +2024,79 @@ def process_interface(path):
         descriptions[key] = {}
       descriptions[key][locale] = element
 
-    extract_string(strings[locale], "title", value.documentElement, "title", "anwv")
+    index = indexes[locale]
+    extract_string(strings[locale], "title", index.get(value.documentElement, "title", "anwv"))
 
     # Store the description blocks
-    set_description("", get_element(value.documentElement, "description", "anwv"))
+    set_description("", index.get(value.documentElement, "description", "anwv"))
 
     # Find all the translations for property, method and method argument descriptions
-    for property in get_element(value.documentElement, "properties").childNodes:
-      property_name = get_text(get_element(property, "name", "anwv")).strip()
+    for property in index.get(value.documentElement, "properties").childNodes:
+      property_name = index.get_text(property, "name", "anwv")
       set_description(property_name + "Description",
-          get_element(property, "description", "anwv"))
-    for method in get_element(value.documentElement, "methods").childNodes:
-      method_name = get_text(get_element(method, "name", "anwv")).strip()
+          index.get(property, "description", "anwv"))
+    for method in index.get(value.documentElement, "methods").childNodes:
+      method_name = index.get_text(method, "name", "anwv")
       set_description(method_name + "Description",
-          get_element(method, "description", "anwv"))
+          index.get(method, "description", "anwv"))
       set_description(method_name + "_returnDescription",
-          get_element(method, "return_description", "anwv"))
-      for argument in get_element(method, "arguments").childNodes:
-        argument_name = get_text(get_element(argument, "name", "anwv")).strip()
+          index.get(method, "return_description", "anwv"))
+      for argument in index.get(method, "arguments").childNodes:
+        argument_name = index.get_text(argument, "name", "anwv")
         set_description(method_name + "_" + argument_name + "Description",
-            get_element(argument, "description", "anwv"))
+            index.get(argument, "description", "anwv"))
 
   # Translate the strings in the descriptions
   for key in descriptions:
-    process_body(descriptions[key], strings, key + "-" if key else "")
+    process_body(align(descriptions[key]), strings, key + "-" if key else "")
 
   # Write general interface strings to the interface.json locale file
   localefile = os.path.join(output_dir, "locales", "en", "interface.json")
-  save_locale(localefile, OrderedDict([
+  shared_locales[localefile] = OrderedDict([
     ("general_notes", { "message": "General notes" }),
     ("toc_header", {"message": "Methods and properties" }),
     ("minversion_label", {"message": "Version:" }),
     ("minversion_addendum", {"message": "and higher" }),
     ("arguments_label", {"message": "Arguments:" }),
     ("returnvalue_label", {"message": "Returns:" })
-  ]))
-
-  pagedata = ""
-  for key, value in descriptions.iteritems():
-    if key:
-      pagedata += "{%% macro %s() %%}\n" % key
-    pagedata += raw_to_template(xml_to_text(value["en"], strings)).lstrip()
-    if key:
-      pagedata += "{% endmacro %}\n"
-    pagedata += "\n"
-
-  pagedata = """title=%s
-
-%s
-
-%s
-
-%s
+  ])
+
+  # The macros are rendered one at a time as the file is written
+  def render_macros():
+    for key, value in descriptions.iteritems():
+      if key:
+        yield "{%% macro %s() %%}\n" % key
+      yield raw_to_template(xml_to_text(value["en"], strings)).lstrip()
+      if key:
+        yield "{% endmacro %}\n"
+      yield "\n"
+
+  header = "title=%s\n\n%s\n\n%s\n\n" % (
+    strings["en"]["title"]["message"],
+    license_header,
+    '<h2>{{ get_string("general_notes", "interface") }}</h2>'
+  )
+  footer = """
 {#
   Property, method and method argument descriptions are defined in the macros
   above and only referenced here.
 #}
 
-{%% from "includes/interface" import display_interface %%}
+{% from "includes/interface" import display_interface %}
 
-{{ display_interface(%s) }}
-""" % (
-    strings["en"]["title"]["message"],
-    license_header,
-    '<h2>{{ get_string("general_notes", "interface") }}</h2>',
-    pagedata,
-    re.sub(r'"\$.*?\$"', lambda match: json.loads(match.group(0))[1:-1], json.dumps(interface, indent=2, separators=(',', ': ')))
-  )
+{{ display_interface("""
   del strings["en"]["title"]
 
   # Save the page's HTML
   target = os.path.join(output_dir, "pages", pagename + ".tmpl")
-  ensure_dir(target)
-  with codecs.open(target, "wb", encoding="utf-8") as handle:
-    handle.write(pagedata)
+  save_file(target, itertools.chain([header], render_macros(), [footer],
+                                    iter_template_json(interface), [") }}\n"]))
   # Save all the translations of strings for the page
   for locale, value in strings.iteritems():
     if value:
       localefile = os.path.join(output_dir, "locales", locale, pagename + ".json")
       save_locale(localefile, value)
+  release_documents(path, data.itervalues())
 
 def process_preftable(path):
   pagename = os.path.join(os.path.dirname(path), os.path.basename(path).replace("preftable!", ""))
@@ -621,27 +2108,29 @@ def process_preftable(path):
   descriptions = {}
   tables = {}
 
-  for locale in locales:
-    if not os.path.exists(format % locale):
-      continue
+  indexes = {}
+
+  for locale in get_input_locales(format):
     data[locale] = read_xml(format % locale)
     strings[locale] = OrderedDict()
     tables[locale] = []
+    indexes[locale] = ElementIndex(data[locale])
 
   # Table sections
   sections = []
-  for section in get_element(data["en"].documentElement, "sections").childNodes:
-    section_id = get_text(get_element(section, "id", "anwv")).strip()
+  index = indexes["en"]
+  for section in index.get(data["en"].documentElement, "sections").childNodes:
+    section_id = index.get_text(section, "id", "anwv")
     new_section = OrderedDict(id=section_id)
-    title = get_text(get_element(section, "title", "anwv")).strip()
+    title = index.get_text(section, "title", "anwv")
     new_section["title"] = "$'%s'|translate('%sTitle')$" % (title.replace("'", "\\'"), section_id)
     new_section["preferences"] = []
 
-    for preference in get_element(section, "preferences").childNodes:
-      preference_name = get_text(get_element(preference, "name", "anwv")).strip()
+    for preference in index.get(section, "preferences").childNodes:
+      preference_name = index.get_text(preference, "name", "anwv")
       new_preference = OrderedDict(name=preference_name)
-      new_preference["default"] = get_text(get_element(preference, "default", "anwv")).strip()
-      if get_text(get_element(preference, "empty", "anwv")).strip() == "true":
+      new_preference["default"] = index.get_text(preference, "default", "anwv")
+      if index.get_text(preference, "empty", "anwv") == "true":
         new_preference["default"] = "$None$"
       new_preference["description"] = "$%sDescription$" % re.sub(r'\W', '', preference_name)
       new_section["preferences"].append(new_preference)
@@ -655,68 +2144,62 @@ def process_preftable(path):
         descriptions[key] = {}
       descriptions[key][locale] = element
 
-    extract_string(strings[locale], "title", value.documentElement, "title", "anwv")
+    index = indexes[locale]
+    root = value.documentElement
+    extract_string(strings[locale], "title", index.get(root, "title", "anwv"))
 
-    set_description("", get_element(value.documentElement, "description", "anwv"))
+    set_description("", index.get(root, "description", "anwv"))
 
     if locale != "en":
-      extract_string(strings[locale], "prefnamecol", value.documentElement, "prefnamecol", "anwv")
-      extract_string(strings[locale], "defaultcol", value.documentElement, "defaultcol", "anwv")
-      extract_string(strings[locale], "descriptioncol", value.documentElement, "descriptioncol", "anwv")
-      extract_string(strings[locale], "empty", value.documentElement, "emptydefault", "anwv")
+      extract_string(strings[locale], "prefnamecol", index.get(root, "prefnamecol", "anwv"))
+      extract_string(strings[locale], "defaultcol", index.get(root, "defaultcol", "anwv"))
+      extract_string(strings[locale], "descriptioncol", index.get(root, "descriptioncol", "anwv"))
+      extract_string(strings[locale], "empty", index.get(root, "emptydefault", "anwv"))
 
-    for section in get_element(value.documentElement, "sections").childNodes:
-      section_id = get_text(get_element(section, "id", "anwv")).strip()
+    for section in index.get(root, "sections").childNodes:
+      section_id = index.get_text(section, "id", "anwv")
       if locale != "en":
-        extract_string(strings[locale], section_id + "Title", section, "title", "anwv")
-      for preference in get_element(section, "preferences").childNodes:
-        preference_name = get_text(get_element(preference, "name", "anwv")).strip()
-        set_description(preference_name, get_element(preference, "description", "anwv"))
+        extract_string(strings[locale], section_id + "Title", index.get(section, "title", "anwv"))
+      for preference in index.get(section, "preferences").childNodes:
+        preference_name = index.get_text(preference, "name", "anwv")
+        set_description(preference_name, index.get(preference, "description", "anwv"))
 
   # Translate the strings in the descriptions
   for key in descriptions:
-    process_body(descriptions[key], strings, re.sub(r'\W', '', key) + "-" if key else "")
-
-  pagedata = ""
-  for key, value in descriptions.iteritems():
-    if key:
-      pagedata += "{%% macro %sDescription() %%}\n" % re.sub(r'\W', '', key)
-    pagedata += raw_to_template(xml_to_text(value["en"], strings)).lstrip()
-    if key:
-      pagedata += "{% endmacro %}\n"
-    pagedata += "\n"
-
-  pagedata = """title=%s
-
-%s
-
-%s
+    process_body(align(descriptions[key]), strings, re.sub(r'\W', '', key) + "-" if key else "")
+
+  # The macros are rendered one at a time as the file is written
+  def render_macros():
+    for key, value in descriptions.iteritems():
+      if key:
+        yield "{%% macro %sDescription() %%}\n" % re.sub(r'\W', '', key)
+      yield raw_to_template(xml_to_text(value["en"], strings)).lstrip()
+      if key:
+        yield "{% endmacro %}\n"
+      yield "\n"
+
+  header = "title=%s\n\n%s\n\n" % (strings["en"]["title"]["message"], license_header)
+  footer = """
 {#
   Preference descriptions are defined in the macros above and only referenced
   here.
 #}
 
-{%% from "includes/preftable" import display_preftable %%}
+{% from "includes/preftable" import display_preftable %}
 
-{{ display_preftable(%s) }}
-""" % (
-    strings["en"]["title"]["message"],
-    license_header,
-    pagedata,
-    re.sub(r'"\$.*?\$"', lambda match: json.loads(match.group(0))[1:-1], json.dumps(sections, indent=2, separators=(',', ': ')))
-  )
+{{ display_preftable("""
   del strings["en"]["title"]
 
   # Save the page's HTML
   target = os.path.join(output_dir, "pages", pagename + ".tmpl")
-  ensure_dir(target)
-  with codecs.open(target, "wb", encoding="utf-8") as handle:
-    handle.write(pagedata)
+  save_file(target, itertools.chain([header], render_macros(), [footer],
+                                    iter_template_json(sections), [") }}\n"]))
   # Save all the translations of strings for the page
   for locale, value in strings.iteritems():
     if value:
       localefile = os.path.join(output_dir, "locales", locale, pagename + ".json")
       save_locale(localefile, value)
+  release_documents(path, data.itervalues())
 
 def process_subscriptionlist(path):
   pagename = os.path.join(os.path.dirname(path), os.path.basename(path).replace("subscriptionlist!", ""))
@@ -729,9 +2212,7 @@ def process_subscriptionlist(path):
   footers = {}
   tables = {}
 
-  for locale in locales:
-    if not os.path.exists(format % locale):
-      continue
+  for locale in get_input_locales(format):
     data[locale] = read_xml(format % locale)
     strings[locale] = OrderedDict()
     tables[locale] = []
@@ -748,7 +2229,7 @@ def process_subscriptionlist(path):
         extract_string(strings[locale], subst_name, subst, "text", "anwv")
 
   # Prepare the header and footer
-  process_body(footers, strings, counter=process_body(headers, strings))
+  process_body(align(footers), strings, counter=process_body(align(headers), strings))
 
   pagedata = ("""title=%s
 %s
@@ -769,14 +2250,13 @@ def process_subscriptionlist(path):
 
   # Save the page's HTML
   target = os.path.join(output_dir, "pages", pagename + ".tmpl")
-  ensure_dir(target)
-  with codecs.open(target, "wb", encoding="utf-8") as handle:
-    handle.write(pagedata)
+  save_file(target, pagedata)
   # Save all the translations of strings for the page
   for locale, value in strings.iteritems():
     if value:
       localefile = os.path.join(output_dir, "locales", locale, pagename + ".json")
       save_locale(localefile, value)
+  release_documents(path, data.itervalues())
 
 def process_animation(path):
   animation_name = os.path.basename(path).replace("animation!anim_", "").replace(".xml", "")
@@ -791,26 +2271,53 @@ def process_animation(path):
   animation_data.setAttribute("width", width)
   animation_data.setAttribute("height", height)
 
+  target = os.path.join(output_dir, "pages", "animations", animation_name + ".xml.tmpl")
   for child in animation_data.childNodes:
     if (child.nodeType == Node.ELEMENT_NODE and
         child.tagName == "object" and
         child.hasAttribute("src")):
+      # inline_file reads the file from the static directory, the image gets
+      # there from its input file
+      src = child.getAttribute("src")
+      record_dependency(target, get_static_image(src) or os.path.join("static", src.lstrip("/")))
       child.setAttribute("src", "{{'%s'|inline_file}}" % child.getAttribute("src"))
 
   page_data = "template=raw\n\n" + xml_to_text(animation_data) + "\n"
-  target = os.path.join(output_dir, "pages", "animations", animation_name + ".xml.tmpl")
-  ensure_dir(target)
-  with codecs.open(target, "wb", encoding="utf-8") as handle:
-    handle.write(page_data)
+  save_file(target, page_data)
+  release_documents(path, [animation_xml])
 
 def process_file(path, menu):
   if os.path.basename(path) in ("page!footer", "page!internet-explorer"):
     return
 
+  if tracer is not None:
+    tracer.start_file(path)
+  try:
+    if match_path(path, profile_patterns):
+      profiler = cProfile.Profile()
+      profiler.runcall(convert_file, path, menu)
+      target = os.path.join(profile_dir, path.replace("/", "_") + ".pstats")
+      ensure_dir(target)
+      profiler.dump_stats(target)
+    else:
+      convert_file(path, menu)
+  finally:
+    if tracer is not None:
+      tracer.end_file()
+  if memory_budget is not None:
+    check_memory_budget(path)
+
+def match_path(path, patterns):
+  """Checks whether an input file matches any of the glob patterns. They can
+  leave out the page! prefix and the directory, en/faq* and interface!* both
+  work."""
+  basename = os.path.basename(path)
+  names = (path, path.replace("page!", ""), basename, basename.replace("page!", ""))
+  return any(fnmatch.fnmatch(name, pattern) for pattern in patterns for name in names)
+
+def convert_file(path, menu):
   if os.path.basename(path).startswith("page!"):
     process_page(path, menu)
-  elif os.path.basename(path).startswith("image!"):
-    process_image(path)
   elif os.path.basename(path).startswith("interface!"):
     process_interface(path)
   elif os.path.basename(path).startswith("preftable!"):
@@ -822,68 +2329,983 @@ def process_file(path, menu):
   else:
     print >>sys.stderr, "Ignoring file %s" % path
 
-def process(path, menu):
-  if os.path.isfile(path):
-    process_file(path, menu)
-  elif os.path.isdir(path):
-    for filename in os.listdir(path):
-      process(os.path.join(path, filename), menu)
+def get_input_files(path):
+  basename = os.path.basename(path)
+  if basename in ("page!footer", "page!internet-explorer"):
+    return None
+
+  if basename.startswith("image!"):
+    inputs = [path]
+    if path.startswith("en/"):
+      inputs.extend(locale + path[2:] for locale in locales if locale != "en")
+  elif basename.startswith("animation!"):
+    inputs = [path]
+  elif basename.split("!")[0] in ("page", "interface", "preftable", "subscriptionlist"):
+    format = "%s/" + path.split("/", 1)[1] if "/" in path else "page!%s"
+    inputs = [format % locale for locale in get_input_locales(format)]
+  else:
+    return None
+  return inputs
+
+def get_inputs(path):
+  inputs = get_input_files(path)
+  if inputs is None:
+    return None
+  return {input: hash_file(input) for input in inputs if input_exists(input)}
+
+def load_inputs(path):
+  """Returns the path along with the content of its input files and their
+  hashes, like get_inputs() returns them but without reading the files twice."""
+  inputs = get_input_files(path)
+  files = {}
+  for input in inputs or ():
+    try:
+      with open(input, "rb") as handle:
+        files[input] = handle.read()
+    except IOError:
+      # Left for the converter to read, and fail on
+      pass
+  if inputs is None:
+    return path, files, None
+  return path, files, {input: hashlib.sha1(data).hexdigest()
+                       for input, data in files.iteritems() if input_exists(input)}
+
+def read_ahead_inputs(paths, count):
+  """Yields the paths along with the content of their input files, loaded on
+  background threads for up to count paths ahead. The converter gets to parse
+  one file while the next ones are read from the disk."""
+  pool = multiprocessing.pool.ThreadPool(min(count, read_threads))
+  paths = iter(paths)
+  pending = deque(pool.apply_async(load_inputs, (path,)) for path in itertools.islice(paths, count))
+  try:
+    while pending:
+      path, files, hashes = pending.popleft().get()
+      for next_path in itertools.islice(paths, 1):
+        pending.append(pool.apply_async(load_inputs, (next_path,)))
+      yield path, files, hashes
+    pool.close()
+  finally:
+    pool.terminate()
+    pool.join()
+
+def hash_inputs(paths):
+  """Yields the paths along with the hashes of their input files, the files
+  are hashed on background threads."""
+  paths = list(paths)
+  pool = multiprocessing.pool.ThreadPool(read_threads)
+  try:
+    for item in itertools.izip(paths, pool.imap(get_inputs, paths)):
+      yield item
+    pool.close()
+  finally:
+    pool.terminate()
+    pool.join()
+
+def hash_file(path):
+  result = hashlib.sha1()
+  with open(path, "rb") as handle:
+    for block in iter(lambda: handle.read(1024 * 1024), ""):
+      result.update(block)
+  return result.hexdigest()
+
+def load_manifest():
+  try:
+    with open(manifest_file, "rb") as handle:
+      return json.load(handle)
+  except IOError, e:
+    if e.errno != errno.ENOENT:
+      raise
+    return {}
+
+def save_manifest(manifest):
+  write_file(manifest_file, json.dumps(manifest, indent=2, separators=(',', ': '), sort_keys=True))
+
+def save_changes():
+  """Writes the list of outputs added, changed and removed in this run, for
+  deployment steps which only want to look at those."""
+  changes = {"added": [], "changed": [], "removed": []}
+  for path, (old, new) in output_changes.iteritems():
+    if old == new:
+      continue
+    elif old is None:
+      kind = "added"
+    elif new is None:
+      kind = "removed"
+    else:
+      kind = "changed"
+    changes[kind].append(os.path.relpath(path, output_dir))
+  for paths in changes.itervalues():
+    paths.sort()
+  write_file(changes_file, json.dumps(changes, indent=2, separators=(',', ': '), sort_keys=True))
+  return changes
+
+def remove_output(path):
+  if os.path.exists(path):
+    record_change(path, hash_file(path), None)
+    remove_file(path)
+
+def remove_file(path):
+  try:
+    os.remove(path)
+  except OSError, e:
+    if e.errno != errno.ENOENT:
+      raise
+
+def list_files(path):
+  if input_dirs is None:
+    index_inputs()
+  if path in input_files:
+    yield path
+  elif path in input_dirs:
+    for filename, is_dir in input_dirs[path]:
+      for result in list_files(os.path.join(path, filename)):
+        yield result
   else:
     print >>sys.stderr, "Ignoring file %s" % path
 
-def process_menu():
-  menu = {}
+def init_worker(menu):
+  global worker_menu, output_sink, parent_sink
+  worker_menu = menu
+  if not output_sink.incremental:
+    # The outputs are handed back to the parent process which has the archive.
+    # Its sink stays referenced here, collecting it would finish the archive.
+    parent_sink, output_sink = output_sink, MemorySink()
+
+def process_file_worker(path):
+  global budget_exceeded
+  budget_exceeded = 0
+  memory_usage.clear()
+  shared_locales.clear()
+  del written_files[:]
+  output_changes.clear()
+  dependencies.clear()
+  for key in attribute_parser.stats:
+    attribute_parser.stats[key] = 0
+  if tracer is not None:
+    del tracer.files[:]
+  if isinstance(output_sink, MemorySink):
+    output_sink.files.clear()
+  error = None
+  try:
+    process_file(path, worker_menu)
+  except Exception:
+    # Tracebacks don't survive the trip back to the parent process
+    if not keep_going:
+      raise Exception("Failed to convert %s:\n%s" % (path, traceback.format_exc()))
+    error = traceback.format_exc()
+  return {
+    "path": path,
+    "error": error,
+    "shared_locales": shared_locales,
+    "written_files": written_files,
+    "output_changes": output_changes,
+    "dependencies": dependencies,
+    "stats": attribute_parser.stats,
+    "traced_files": tracer.files if tracer is not None else None,
+    "memory_usage": memory_usage,
+    "budget_exceeded": budget_exceeded,
+    "files": output_sink.files.items() if isinstance(output_sink, MemorySink) else None
+  }
+
+def process(paths, menu, jobs=1, check=None):
+  """Converts the given files, yielding each path along with the output files
+  that were written for it and the traceback if it failed with keep_going.
+  If given, check is called with each path and the hashes of its inputs first,
+  files it returns True for are skipped."""
+  if jobs == 1:
+    if read_ahead:
+      paths = read_ahead_inputs(paths, read_ahead)
+    elif check is not None:
+      paths = ((path, {}, hashes) for path, hashes in hash_inputs(paths))
+    else:
+      paths = ((path, {}, None) for path in paths)
+    for path, files, hashes in paths:
+      if check is not None and check(path, hashes):
+        continue
+      del written_files[:]
+      prefetched.update(files)
+      error = None
+      try:
+        process_file(path, menu)
+      except Exception:
+        if not keep_going:
+          raise
+        error = traceback.format_exc()
+      finally:
+        prefetched.clear()
+      yield path, list(written_files), error
+    return
+
+  # With a memory budget the files are handed out in batches, workers which
+  # exceeded it are replaced by fresh processes between two batches.
+  global budget_exceeded
+  batch_size = jobs * 16 if memory_budget is not None else None
+  if check is not None:
+    paths = (path for path, hashes in hash_inputs(paths) if not check(path, hashes))
+  paths = iter(paths)
+  pool = None
+  try:
+    while True:
+      batch = list(itertools.islice(paths, batch_size))
+      if not batch:
+        break
+      if pool is None:
+        pool = multiprocessing.Pool(jobs, init_worker, (menu,))
+      recycle = False
+      for result in pool.imap(process_file_worker, batch):
+        shared_locales.update(result["shared_locales"])
+        for changed_path, (old, new) in result["output_changes"].iteritems():
+          record_change(changed_path, old, new)
+        for output, extra in result["dependencies"].iteritems():
+          dependencies.setdefault(output, set()).update(extra)
+        for key, value in result["stats"].iteritems():
+          attribute_parser.stats[key] += value
+        if result["traced_files"]:
+          tracer.files.extend(result["traced_files"])
+        merge_memory_usage(result["memory_usage"])
+        budget_exceeded += result["budget_exceeded"]
+        for output_path, data in result["files"] or ():
+          output_sink.save(output_path, data)
+        recycle = recycle or result["budget_exceeded"]
+        yield result["path"], result["written_files"], result["error"]
+      if recycle:
+        print >>sys.stderr, "Restarting the worker processes to stay within the memory budget"
+        pool.close()
+        pool.join()
+        pool = None
+    if pool is not None:
+      pool.close()
+  finally:
+    if pool is not None:
+      pool.terminate()
+      pool.join()
+
+def process_inputs(paths, menu, jobs=1, check=None):
+  """Converts the given files, images are copied on threads of their own.
+  Yields the same as process()."""
+  paths = list(paths)
+  images = [path for path in paths if os.path.basename(path).startswith("image!")]
+  others = [path for path in paths if not os.path.basename(path).startswith("image!")]
+  if check is not None:
+    images = [path for path, hashes in hash_inputs(images) if not check(path, hashes)]
+  return itertools.chain(process(others, menu, jobs, check), process_images(images))
+
+def process_all(paths, menu, jobs=1):
+  """Converts all the given files regardless of earlier runs, for sinks which
+  don't keep the outputs around. Returns the failures like process_changed()."""
+  return [(path, error) for path, written, error in process_inputs(paths, menu, jobs)
+          if error is not None]
+
+def load_journal():
+  done = {}
+  try:
+    with open(journal_file, "rb") as handle:
+      for line in handle:
+        try:
+          record = json.loads(line)
+        except ValueError:
+          # The last line is incomplete if the run was killed while writing it
+          continue
+        done[record["path"]] = record["entry"]
+  except IOError, e:
+    if e.errno != errno.ENOENT:
+      raise
+  return done
+
+def process_changed(paths, menu, jobs=1, force=False, partial=False, resume=False):
+  """Converts the files whose inputs changed since the last run, as recorded in
+  the manifest, and removes the outputs of files which are gone. For partial
+  runs, paths and locales are only a selection, the manifest entries of other
+  files and the outputs for other locales are left alone then.
+
+  Every converted file is recorded in the journal right away, if the run is
+  aborted, resume skips the files it got done. Returns the files which failed
+  to convert with keep_going, along with their tracebacks. The dependencies of
+  the outputs listed in the manifest end up in dependency_graph."""
+  converter = hash_file(converter_file)
+  if dedup_images:
+    # Outputs differ with this option, entries written without it don't apply
+    converter += "+dedup-images"
+  if shared_strings:
+    # The templates refer to the shared locale file, a run without it has to
+    # convert them again
+    converter += "+shared-strings"
+  if image_copy != "copy":
+    # Existing copies are only replaced by links, and the other way round, when
+    # the images are copied again
+    converter += "+link-images=" + image_copy
+  if xml_parser != "expat":
+    converter += "+parser=" + xml_parser
+  if selected_locales is not None:
+    # Only the outputs of these locales are up to date, the next full run has
+    # to convert the file again
+    converter += "+locales=" + ",".join(selected_locales)
+  manifest = {} if force and not partial else load_manifest()
+  done = load_journal() if resume else {}
+  inputs = OrderedDict((path, None) for path in paths)
+  reusable = {}
+  for path in inputs:
+    entry = done.get(path) or manifest.get(path)
+    if ((not force or path in done) and entry and entry["converter"] == converter and
+        all(os.path.exists(os.path.join(output_dir, f)) for f in entry["outputs"])):
+      reusable[path] = entry
+
+  ensure_dir(journal_file)
+  journal = open(journal_file, "wb")
+  entries = {}
+
+  # The inputs are hashed as they are loaded for the conversion, files whose
+  # inputs didn't change are skipped then.
+  def check(path, hashes):
+    inputs[path] = hashes
+    entry = reusable.get(path)
+    if hashes is None or entry is None or entry["inputs"] != hashes:
+      return False
+    entries[path] = entry
+    if path in done:
+      journal.write(json.dumps({"path": path, "entry": entry}) + "\n")
+    return True
+
+  failures = []
+  for path, written, error in process_inputs(inputs.keys(), menu, jobs, check):
+    extra = OrderedDict((os.path.relpath(f, output_dir), sorted(dependencies.pop(f)))
+                        for f in written if f in dependencies)
+    if error is not None:
+      failures.append((path, error))
+      # Keep the outputs of the previous run, the file is converted again
+      # next time since the manifest still has the old inputs
+      if path in manifest:
+        entries[path] = manifest[path]
+      continue
+    if inputs[path] is not None:
+      outputs = set(os.path.relpath(f, output_dir) for f in written)
+      if partial and path in manifest:
+        # The outputs of other locales weren't written, they stay until the next
+        # full run converts this file again.
+        outputs.update(f for f in manifest[path]["outputs"]
+                       if not is_selected(os.path.join(output_dir, f)))
+      entries[path] = {
+        "converter": converter,
+        "inputs": inputs[path],
+        "outputs": sorted(outputs)
+      }
+      if extra:
+        entries[path]["dependencies"] = extra
+      journal.write(json.dumps({"path": path, "entry": entries[path]}) + "\n")
+      journal.flush()
+
+  if partial:
+    for path, entry in manifest.iteritems():
+      if path not in inputs:
+        entries[path] = entry
+
+  current = set(f for entry in entries.itervalues() for f in entry["outputs"])
+  for entry in manifest.itervalues():
+    for f in entry["outputs"]:
+      if f not in current:
+        remove_output(os.path.join(output_dir, f))
+  save_manifest(entries)
+  journal.close()
+  remove_file(journal_file)
+
+  dependency_graph.clear()
+  for entry in entries.itervalues():
+    extra = entry.get("dependencies", {})
+    for f in entry["outputs"]:
+      dependency_graph[f] = sorted(set(entry["inputs"]).union(extra.get(f, ())))
+  return failures
+
+def load_dependencies():
+  try:
+    with open(dependency_file, "rb") as handle:
+      return json.load(handle)
+  except IOError, e:
+    if e.errno != errno.ENOENT:
+      raise
+    return None
+
+def save_dependencies():
+  """Writes the dependency graph of the output directory. Outputs which aren't
+  converted per input file, like menu.json, get the dependencies recorded in
+  this run, or keep those of earlier runs if they weren't written."""
+  graph = dict(dependency_graph)
+  for output, paths in dependencies.iteritems():
+    graph[os.path.relpath(output, output_dir)] = sorted(paths)
+  for output, paths in (load_dependencies() or {}).iteritems():
+    if output not in graph and os.path.exists(os.path.join(output_dir, output)):
+      graph[output] = paths
+  write_file(dependency_file, json.dumps(graph, indent=2, separators=(',', ': '), sort_keys=True))
+
+def get_affected(graph, patterns):
+  """Returns the outputs which depend on any of the inputs or outputs matching
+  the patterns, directly or through other outputs."""
+  dependents = {}
+  for output, paths in graph.iteritems():
+    for path in paths:
+      dependents.setdefault(path, []).append(output)
+  stack = [path for path in dependents if match_path(path, patterns)]
+  affected = set()
+  while stack:
+    for output in dependents.get(stack.pop(), ()):
+      if output not in affected:
+        affected.add(output)
+        stack.append(output)
+  return sorted(affected)
+
+def unescape_default(text):
+  # Reverses the escaping of default texts in raw_to_template()
+  return re.sub(r"\\(.)", lambda match: {"r": "\r", "n": "\n"}.get(match.group(1), match.group(1)), text)
+
+def share_strings():
+  """Moves strings which several template pages have in common, translated
+  identically in all locales, to a shared locale file. The pages refer to them
+  with get_string() then. Only plain text is shared, strings with links or
+  other markup need translate(). The English text comes from the defaults in
+  the templates, it is part of what has to match and goes to the shared
+  English locale file. Returns the shared locale files written."""
+  pages_dir = os.path.join(output_dir, "pages")
+  translate_regexp = re.compile(r'{{"((?:[^"\\]|\\.)*)"\|translate\("([\w\-]+)"\)}}')
+
+  pages = {}
+  usage = {}
+  for dirpath, dirnames, filenames in os.walk(pages_dir):
+    for filename in sorted(filenames):
+      if not filename.endswith(".tmpl"):
+        continue
+      target = os.path.join(dirpath, filename)
+      pagename = os.path.relpath(target, pages_dir)[:-len(".tmpl")]
+      with open(target, "rb") as handle:
+        template = handle.read().decode("utf-8")
+      strings = OrderedDict()
+      for locale in locales:
+        localefile = os.path.join(output_dir, "locales", locale, pagename + ".json")
+        if os.path.exists(localefile):
+          with open(localefile, "rb") as handle:
+            strings[locale] = json.load(handle, object_pairs_hook=OrderedDict)
+      pages[pagename] = (target, template, strings)
+
+      defaults = {}
+      for match in translate_regexp.finditer(template):
+        defaults.setdefault(match.group(2), unescape_default(match.group(1)))
+      for key in sorted(defaults):
+        entry = dict((locale, value[key]) for locale, value in strings.iteritems() if key in value)
+        entry["en"] = {"message": defaults[key]}
+        if len(entry) < 2 or any("<" in value["message"] or "{" in value["message"]
+                                 for value in entry.itervalues()):
+          continue
+        usage.setdefault(json.dumps(entry, sort_keys=True), []).append((pagename, key))
+
+  shared = {}
+  replacements = {}
+  for text, uses in usage.iteritems():
+    if len(set(pagename for pagename, key in uses)) < 2:
+      continue
+    name = "s" + hashlib.sha1(text).hexdigest()[:8]
+    for locale, value in json.loads(text, object_pairs_hook=OrderedDict).iteritems():
+      shared.setdefault(locale, {})[name] = value
+    for pagename, key in uses:
+      replacements.setdefault(pagename, {})[key] = name
+
+  for pagename, names in replacements.iteritems():
+    target, template, strings = pages[pagename]
+    def replace(match):
+      if match.group(2) in names:
+        return '{{ get_string("%s", "%s") }}' % (names[match.group(2)], shared_localefile)
+      return match.group(0)
+    save_file(target, translate_regexp.sub(replace, template))
+    for locale, value in strings.iteritems():
+      for key in names:
+        value.pop(key, None)
+      localefile = os.path.join(output_dir, "locales", locale, pagename + ".json")
+      # Like the handlers, don't keep locale files without strings around
+      if value:
+        save_locale(localefile, value)
+      else:
+        remove_output(localefile)
 
-  menu_format = "%s/_include/menu!menu"
-  footer_format = "%s/_include/page!footer"
+  written = set()
+  for locale, value in shared.iteritems():
+    if not value:
+      continue
+    localefile = os.path.join(output_dir, "locales", locale, shared_localefile + ".json")
+    save_locale(localefile, OrderedDict(sorted(value.iteritems())))
+    written.add(localefile)
+    for pagename in replacements:
+      record_dependency(localefile, os.path.relpath(pages[pagename][0], output_dir))
+
+  if replacements:
+    print "Moved %i strings used on %i pages to %s.json" % (len(set(n for names in replacements.itervalues() for n in names.itervalues())),
+                                                            len(replacements), shared_localefile)
+  return written
+
+def remove_shared_strings(written):
+  """Removes the shared locale files of earlier runs which this run didn't
+  write, after a full run no template refers to them anymore."""
   for locale in locales:
-    menu[locale] = OrderedDict()
-    if os.path.exists(menu_format % locale):
-      data = read_xml(menu_format % locale)
-      items = get_element(data.documentElement, "items")
-      for node in items.childNodes:
-        text = get_text(get_element(node, "mainlink", "anwv", "title", "anwv")).strip()
-        url = get_text(get_element(node, "mainlink", "anwv", "url", "anwv")).strip()
-        if url == "en":
-          string = "installation"
-        elif url.startswith("en/"):
-          string = url.replace("en/", "")
-        elif url == "/languages/":
-          continue    # Unused string
-        elif url == "/search/":
-          string = "search"
-        else:
-          raise Exception("Unexpected URL in menu: %s" % url)
-        if text and text.find("[untr]") < 0:
-          menu[locale][string] = {"message": text}
-    if os.path.exists(footer_format % locale):
-      data = read_xml(footer_format % locale)
-      for string, heading in itertools.izip(("resources", "community", "development", "follow-us"), data.getElementsByTagName("h1")):
-        extract_string(menu[locale], string, heading)
-      for link in data.getElementsByTagName("a"):
-        url = link.getAttribute("href").replace("/de/", "")
-        if url == "/forum/viewforum.php?f=11":
-          string = "_bugs"
-        elif url.startswith("/"):
-          string = url.strip("/").split("/")[-1]
-        elif url == "https://issues.adblockplus.org/report/13":
-          string = "roadmap"
-        else:
-          string = url
-        extract_string(menu[locale], string, link)
+    localefile = os.path.join(output_dir, "locales", locale, shared_localefile + ".json")
+    if localefile not in written:
+      remove_output(localefile)
+
+def get_menu_string(url):
+  if url == "en":
+    return "installation"
+  elif url.startswith("en/"):
+    return url.replace("en/", "")
+  elif url == "/languages/":
+    return None
+  elif url == "/search/":
+    return "search"
+  raise Exception("Unexpected URL in menu: %s" % url)
+
+def describe_node(node):
+  if node.nodeType == Node.ELEMENT_NODE:
+    return "<%s>" % node.tagName
+  elif node.nodeType == Node.TEXT_NODE:
+    return "text"
+  return node.nodeName
+
+def check_alignment(en, value, where):
+  """Compares the structure of a locale's element with the en one. Nodes are
+  aligned by their position, so a different number of children makes the
+  translations end up in the wrong strings or get dropped, and elements where
+  en has text end up in localizable strings."""
+  problems = []
+  stack = [(en, value, where)]
+  while stack:
+    en, value, where = stack.pop()
+    if len(value.childNodes) != len(en.childNodes):
+      problems.append("%s has %i child nodes, en has %i, the translations are misaligned" % (
+        where, len(value.childNodes), len(en.childNodes)))
+      continue
+    text = map(is_text, en.childNodes)
+    for i, (en_child, child) in enumerate(itertools.izip(en.childNodes, value.childNodes)):
+      if text[i]:
+        if not is_text(child) and child.nodeType != Node.COMMENT_NODE:
+          problems.append("%s has %s where en has text, it would end up in a localizable string" % (
+            where, describe_node(child)))
+      elif en_child.nodeType == Node.ELEMENT_NODE:
+        if child.nodeType != Node.ELEMENT_NODE or child.tagName != en_child.tagName:
+          problems.append("%s has %s where en has <%s>" % (where, describe_node(child), en_child.tagName))
+        elif en_child.tagName not in ("style", "script", "fix", "pre"):
+          stack.append((en_child, child, "%s/%s[%i]" % (where, en_child.tagName, i)))
+  return problems
+
+def check_strings(nodes, where):
+  """Walks the elements of all locales like process_body() does and parses the
+  localizable strings it would extract, en included. Returns the problems
+  found as (locale, message) tuples."""
+  problems = []
+  strings = defaultdict(OrderedDict)
+  stack = [align(nodes)]
+  while stack:
+    node = stack.pop()
+    en = node.node
+    if en.nodeType == Node.ELEMENT_NODE and en.tagName not in ("style", "script", "fix", "pre"):
+      try:
+        process_links(node, strings, "", 1)
+        # squash_attrs() turns these into attributes of the element
+        for child in en.childNodes:
+          if child.nodeType == Node.ELEMENT_NODE and child.tagName == "attr":
+            get_text(child)
+      except Exception, e:
+        problems.append(("en", "%s: %s" % (where, e)))
+        continue
+      merge_children(node)
+      stack.extend(reversed(node.children))
+    elif en.nodeType == Node.TEXT_NODE:
+      for locale, value in itertools.izip(node.locales, node.values):
+        text = get_value_text(value).strip() if value is not None else ""
+        if not text or "[untr]" in text:
+          continue
+        if locale == "en":
+          # The en text ends up in the template, it is unescaped first
+          text = h.unescape(text)
+        text = re.sub(r"<fix>.*?</fix>", "{1}", text, flags=re.S)
+        try:
+          attribute_parser.parse(text, where)
+        except Exception, e:
+          problems.append((locale, str(e)))
+  return problems
+
+def get_string_elements(kind, document, en):
+  """Returns the elements the handler for the kind of file extracts strings
+  from with process_body(), by key. The texts the handler reads along the way
+  are looked up as well, an exception is raised where the handler would fail."""
+  root = document.documentElement
+  elements = OrderedDict()
+  if kind == "page":
+    get_text(get_element(root, "title", "anwv"))
+    for name in ("head", "body"):
+      elements[name] = get_element(root, name, "anwv")
+  elif kind == "interface":
+    get_text(get_element(root, "title", "anwv"))
+    elements["description"] = get_element(root, "description", "anwv")
+    for property in get_element(root, "properties").childNodes:
+      name = get_text(get_element(property, "name", "anwv")).strip()
+      if en:
+        get_text(get_element(property, "type", "anwv"))
+        get_text(get_element(property, "modifier", "anwv"))
+      elements[name + "/description"] = get_element(property, "description", "anwv")
+    for method in get_element(root, "methods").childNodes:
+      name = get_text(get_element(method, "name", "anwv")).strip()
+      if en:
+        get_text(get_element(method, "return_type", "anwv"))
+        get_text(get_element(method, "version", "anwv"))
+      elements[name + "/description"] = get_element(method, "description", "anwv")
+      elements[name + "/return_description"] = get_element(method, "return_description", "anwv")
+      for argument in get_element(method, "arguments").childNodes:
+        argument_name = get_text(get_element(argument, "name", "anwv")).strip()
+        if en:
+          get_text(get_element(argument, "type", "anwv"))
+        elements["%s/%s/description" % (name, argument_name)] = get_element(argument, "description", "anwv")
+  elif kind == "preftable":
+    get_text(get_element(root, "title", "anwv"))
+    if not en:
+      for name in ("prefnamecol", "defaultcol", "descriptioncol", "emptydefault"):
+        get_text(get_element(root, name, "anwv"))
+    elements["description"] = get_element(root, "description", "anwv")
+    for section in get_element(root, "sections").childNodes:
+      get_text(get_element(section, "id", "anwv"))
+      get_text(get_element(section, "title", "anwv"))
+      for preference in get_element(section, "preferences").childNodes:
+        name = get_text(get_element(preference, "name", "anwv")).strip()
+        if en:
+          get_text(get_element(preference, "default", "anwv"))
+          get_text(get_element(preference, "empty", "anwv"))
+        elements[name] = get_element(preference, "description", "anwv")
+  elif kind == "subscriptionlist":
+    get_text(get_element(root, "title", "anwv"))
+    for name in ("header", "footer"):
+      elements[name] = get_element(root, name, "anwv")
+    for subst in get_element(root, "subst").childNodes:
+      name = get_text(get_element(subst, "name", "anwv")).strip()
+      if name.startswith("type_") or not en:
+        get_text(get_element(subst, "text", "anwv"))
+  return elements
+
+def check_file(path):
+  """Runs the cheap parts of converting a file: parsing all its locales and
+  checking the structure the handlers rely on. Returns the problems found as
+  (input file, message) tuples."""
+  basename = os.path.basename(path)
+  kind = basename.split("!")[0]
+  if basename in ("page!footer", "page!internet-explorer") or kind == "image":
+    return []
+  if kind == "animation":
+    inputs = [path]
+  elif kind in ("page", "interface", "preftable", "subscriptionlist", "menu"):
+    format = "%s/" + path.split("/", 1)[1] if "/" in path else "page!%s"
+    inputs = [format % locale for locale in get_input_locales(format)]
+  else:
+    return []
+
+  problems = []
+  documents = {}
+  for input in inputs:
+    try:
+      documents[input] = read_xml(input)
+    except Exception, e:
+      problems.append((input, "Failed to parse: %s" % e))
+  en = documents.get(inputs[0])
+  locale_inputs = {}
+  elements = {}
+
+  for input, document in documents.iteritems():
+    try:
+      if kind == "menu":
+        for node in get_element(document.documentElement, "items").childNodes:
+          get_text(get_element(node, "mainlink", "anwv", "title", "anwv"))
+          get_menu_string(get_text(get_element(node, "mainlink", "anwv", "url", "anwv")).strip())
+      elif kind == "animation":
+        for name in ("width", "height"):
+          get_text(get_element(document.documentElement, name, "anwv"))
+        for child in get_element(document.documentElement, "data", "anwv").childNodes:
+          if (child.nodeType == Node.ELEMENT_NODE and child.tagName == "object" and
+              child.hasAttribute("src") and get_static_image(child.getAttribute("src")) is None):
+            # Neither inlined properly nor tracked by --affected-by then
+            problems.append((input, "<object> refers to %s, no image in images/ provides it" %
+                             child.getAttribute("src")))
+      else:
+        locale = input.split("/")[0] if "/" in input else input.split("!")[1]
+        elements[locale] = get_string_elements(kind, document, document is en)
+        locale_inputs[locale] = input
+    except Exception, e:
+      problems.append((input, str(e)))
+
+  if "en" not in elements:
+    return problems
+  for key, en_element in elements["en"].iteritems():
+    nodes = {"en": en_element}
+    for locale, values in elements.iteritems():
+      element = values.get(key)
+      if locale == "en" or element is None or en_element is None:
+        continue
+      problems.extend((locale_inputs[locale], message)
+                      for message in check_alignment(en_element, element, key))
+      nodes[locale] = element
+    if en_element is None:
+      if kind != "page":
+        problems.append((locale_inputs["en"], "%s is missing" % key))
+    elif key != "head":
+      # The head isn't searched for strings
+      problems.extend((locale_inputs[locale], message)
+                      for locale, message in check_strings(nodes, key))
+  for locale, values in elements.iteritems():
+    for key in values:
+      if key not in elements["en"]:
+        problems.append((locale_inputs[locale], "%s isn't in en, the conversion would fail" % key))
+  return problems
+
+def check_inputs(paths, jobs=1):
+  """Checks all the given input files, in parallel if jobs is more than one.
+  Yields the problems found."""
+  if jobs == 1:
+    for path in paths:
+      for problem in check_file(path):
+        yield problem
+    return
+
+  pool = multiprocessing.Pool(jobs)
+  try:
+    for problems in pool.imap(check_file, paths, 16):
+      for problem in problems:
+        yield problem
+    pool.close()
+  finally:
+    pool.terminate()
+    pool.join()
+
+menu_format = "%s/_include/menu!menu"
+footer_format = "%s/_include/page!footer"
+
+def extract_menu_strings(strings, path):
+  data = read_xml(path)
+  items = get_element(data.documentElement, "items")
+  for node in items.childNodes:
+    text = get_text(get_element(node, "mainlink", "anwv", "title", "anwv")).strip()
+    url = get_text(get_element(node, "mainlink", "anwv", "url", "anwv")).strip()
+    string = get_menu_string(url)
+    if string is None:
+      continue    # Unused string
+    if text and text.find("[untr]") < 0:
+      strings[string] = {"message": text}
+
+def extract_footer_strings(strings, path):
+  data = read_xml(path)
+  for string, heading in itertools.izip(("resources", "community", "development", "follow-us"), data.getElementsByTagName("h1")):
+    extract_string(strings, string, heading)
+  for link in data.getElementsByTagName("a"):
+    url = link.getAttribute("href").replace("/de/", "")
+    if url == "/forum/viewforum.php?f=11":
+      string = "_bugs"
+    elif url.startswith("/"):
+      string = url.strip("/").split("/")[-1]
+    elif url == "https://issues.adblockplus.org/report/13":
+      string = "roadmap"
+    else:
+      string = url
+    extract_string(strings, string, link)
+
+def process_menu(failures=None):
+  """Collects the menu strings of all locales. With keep_going, locales whose
+  menu or footer fails to convert are left out and added to failures."""
+  menu = {}
+  for locale in locales:
+    menufile = os.path.join(output_dir, "locales", locale, "menu.json")
+    strings = OrderedDict()
+    try:
+      for format, extract in ((menu_format, extract_menu_strings), (footer_format, extract_footer_strings)):
+        path = format % locale
+        if input_exists(path):
+          record_dependency(menufile, path)
+          extract(strings, path)
+    except Exception:
+      if not keep_going:
+        raise
+      dependencies.pop(menufile, None)
+      failures.append((path, traceback.format_exc()))
+      continue
+    menu[locale] = strings
   return menu
 
 if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Converts the Anwiki content mirror to the CMS format.")
+  parser.add_argument("-j", "--jobs", type=int,
+                      help="number of files to convert in parallel, 0 for one per CPU (default: 1, one per CPU with --check)")
+  parser.add_argument("-f", "--force", action="store_true",
+                      help="convert all files, even those whose inputs didn't change since the last run")
+  parser.add_argument("--parser", choices=("expat", "minidom"), default=xml_parser,
+                      help="XML parser backend (default: %(default)s)")
+  parser.add_argument("--shared-strings", action="store_true",
+                      help="move strings that template pages have in common to a shared locale file, implies --force")
+  parser.add_argument("--link-images", choices=("copy", "hardlink", "reflink"), default=image_copy,
+                      help="how to put images into the output directory, hardlinks share the data with the input (default: %(default)s)")
+  parser.add_argument("--dedup-images", action="store_true",
+                      help="leave out locale variants of images which are identical to the English ones")
+  parser.add_argument("--timings", action="store_true",
+                      help="print how much time the stages of the conversion took")
+  parser.add_argument("--trace", metavar="FILE",
+                      help="write the timings of every file and stage as Chrome trace JSON")
+  parser.add_argument("--profile", metavar="PATTERN", action="append", default=[],
+                      help="run cProfile for the input files matching this glob pattern, e.g. 'en/faq'")
+  parser.add_argument("--profile-dir", default=profile_dir,
+                      help="directory to write the profiles to (default: %(default)s)")
+  parser.add_argument("--bounded-memory", action="store_true",
+                      help="free the documents of every file right after converting it and report the memory use")
+  parser.add_argument("--memory-budget", type=float, metavar="MB",
+                      help="warn when a process uses more memory, parallel runs restart their workers, implies --bounded-memory")
+  parser.add_argument("-k", "--keep-going", action="store_true",
+                      help="convert the other files if one fails, list the failures at the end")
+  parser.add_argument("--resume", action="store_true",
+                      help="skip the files an aborted run got done")
+  parser.add_argument("--check", action="store_true",
+                      help="only check the input files for problems which would break or spoil the conversion")
+  parser.add_argument("--pages", metavar="PATTERN", action="append", default=[],
+                      help="only convert the input files matching this glob pattern, e.g. 'en/faq*' or 'interface!*'")
+  parser.add_argument("--locales", type=lambda s: s.split(","),
+                      help="comma separated locales to convert, en is always included")
+  parser.add_argument("--read-ahead", type=int, metavar="N", default=read_ahead,
+                      help="number of files whose inputs serial runs load ahead on background threads, 0 to disable (default: %(default)s)")
+  parser.add_argument("--affected-by", metavar="PATH", action="append", default=[],
+                      help="only list the outputs which need to be regenerated when this input (or output, glob patterns work too) changes")
+  parser.add_argument("--archive", metavar="FILE",
+                      help="write all outputs into a .tar, .tar.gz, .tgz, .tar.bz2 or .zip archive instead of the output directory")
+  args = parser.parse_args()
+  if args.locales:
+    unknown = set(args.locales) - set(locales)
+    if unknown:
+      parser.error("unknown locales: %s" % ", ".join(sorted(unknown)))
+    selected_locales = tuple(locale for locale in locales if locale == "en" or locale in args.locales)
+  if args.jobs is None:
+    args.jobs = 0 if args.check else 1
+  partial = bool(args.pages or args.locales)
+  keep_going = args.keep_going
+  if partial and args.shared_strings:
+    parser.error("--shared-strings needs all pages and locales")
+  if args.archive:
+    if not ArchiveSink.supports(args.archive):
+      parser.error("unsupported archive format: %s" % args.archive)
+    if partial or args.shared_strings or args.resume or args.link_images != "copy":
+      parser.error("--archive always converts everything into a new archive, it doesn't work with --pages, --locales, --shared-strings, --resume or --link-images")
+    archive_file = os.path.abspath(args.archive)
+
+  xml_parser = args.parser
+  read_ahead = max(args.read_ahead, 0)
+  image_copy = args.link_images
+  dedup_images = args.dedup_images
+  shared_strings = args.shared_strings
+  if args.timings or args.trace:
+    tracer = Tracer()
+  profile_patterns = args.profile
+  profile_dir = os.path.abspath(args.profile_dir)
+  trace_file = os.path.abspath(args.trace) if args.trace else None
+  bounded_memory = args.bounded_memory or args.memory_budget is not None
+  if args.memory_budget is not None:
+    memory_budget = int(args.memory_budget * 1024 * 1024)
+
+  if args.affected_by:
+    graph = load_dependencies()
+    if graph is None:
+      print >>sys.stderr, "No dependency graph in %s, convert the content first" % output_dir
+      sys.exit(1)
+    nodes = set(graph).union(*graph.itervalues())
+    unmatched = [pattern for pattern in args.affected_by
+                 if not any(match_path(node, [pattern]) for node in nodes)]
+    for pattern in unmatched:
+      # Most likely a typo or a path without its locale, don't pretend nothing
+      # depends on it
+      print >>sys.stderr, "No inputs or outputs match %s" % pattern
+    for output in get_affected(graph, args.affected_by):
+      print output
+    sys.exit(1 if unmatched else 0)
+
+  converter_file = os.path.abspath(__file__)
   os.chdir(input_dir)
-  menu = process_menu()
-  process("page!en", menu)
-  process("en", menu)
-  process("images", menu)
-  process("_include", menu)
-
-  for locale, value in menu.iteritems():
-    if "_bugs" in value:
-      value["bugs"] = value["_bugs"]
-      del value["_bugs"]
-    localefile = os.path.join(output_dir, "locales", locale, "menu.json")
-    save_locale(localefile, value)
+  index_inputs()
+
+  if args.check:
+    paths = itertools.chain(*map(list_files, ("page!en", "en", "images", "_include")))
+    if args.pages:
+      paths = (path for path in paths if match_path(path, args.pages))
+    problems = 0
+    for path, message in check_inputs(paths, args.jobs or multiprocessing.cpu_count()):
+      print "%s: %s" % (path, message)
+      problems += 1
+    print "Found %i problems" % problems
+    sys.exit(1 if problems else 0)
+  if args.archive:
+    output_sink = ArchiveSink(archive_file)
+  menu_failures = []
+  try:
+    # The menu is only converted if the selection includes it or the footer
+    if not args.pages or match_path("en/_include/menu!menu", args.pages) or \
+                         match_path("en/_include/page!footer", args.pages):
+      menu = process_menu(menu_failures)
+    else:
+      menu = {}
+    paths = itertools.chain(*map(list_files, ("page!en", "en", "images", "_include")))
+    if args.pages:
+      paths = (path for path in paths if match_path(path, args.pages))
+    if output_sink.incremental:
+      failures = menu_failures + process_changed(
+        paths, menu, args.jobs or multiprocessing.cpu_count(),
+        args.force or args.shared_strings, partial, args.resume)
+    else:
+      failures = menu_failures + process_all(paths, menu, args.jobs or multiprocessing.cpu_count())
+    if output_sink.incremental and not partial:
+      remove_shared_strings(share_strings() if shared_strings else set())
+
+    for localefile, value in shared_locales.iteritems():
+      save_locale(localefile, value)
+
+    for locale, value in menu.iteritems():
+      if "_bugs" in value:
+        value["bugs"] = value["_bugs"]
+        del value["_bugs"]
+      localefile = os.path.join(output_dir, "locales", locale, "menu.json")
+      save_locale(localefile, value)
+  except:
+    output_sink.abort()
+    raise
+  output_sink.close()
+
+  stats = attribute_parser.stats
+  parsed = stats["hits"] + stats["misses"]
+  if parsed:
+    print "Parsed %i localizable strings, %.1f%% cache hits, %i needed HTMLParser" % (
+      parsed, 100.0 * stats["hits"] / parsed, stats["fallbacks"])
+  if copy_stats["copied"] or copy_stats["skipped"]:
+    print "Images: %.1f MB copied, %.1f MB skipped" % (
+      copy_stats["copied"] / 1024.0 / 1024.0, copy_stats["skipped"] / 1024.0 / 1024.0)
+  if copy_stats["duplicates"]:
+    print "Dropped %i locale images identical to the English ones, %.1f MB saved" % (
+      copy_stats["duplicates"], copy_stats["saved"] / 1024.0 / 1024.0)
+
+  if output_sink.incremental:
+    changes = save_changes()
+    save_dependencies()
+    print "Outputs: %i added, %i changed, %i removed" % (
+      len(changes["added"]), len(changes["changed"]), len(changes["removed"]))
+  else:
+    print "Outputs: %i files written to %s" % (len(output_changes), args.archive)
+
+  if args.timings:
+    print
+    tracer.print_summary()
+  if trace_file:
+    tracer.save_chrome_trace(trace_file)
+    print "Trace written to %s" % trace_file
+  if profile_patterns:
+    print "Profiles written to %s, view them with python -m pstats" % profile_dir
+  if bounded_memory:
+    print
+    print_memory_report()
+    if budget_exceeded:
+      print "The memory budget was exceeded after %i files" % budget_exceeded
+  if failures:
+    for path, error in failures:
+      print >>sys.stderr, "Failed to convert %s:\n%s" % (path, error)
+    print "Failed to convert %i files:" % len(failures)
+    for path, error in failures:
+      print "  %s: %s" % (path, error.strip().splitlines()[-1])
+    sys.exit(1)